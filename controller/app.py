@@ -1,10 +1,35 @@
+import os
 import threading
 
 from src import app
+from src.database import pool
 from src.utils.algorithm import load_graph
 from src.utils.apps import Services
+from src.utils.route_engine import route_engine
+from src.utils.tiles import graph_registry
+from src.utils.weather import weather_prefetcher
+
+
+DEBUG = True
+
+
+def init_routing():
+    load_graph()
+    route_engine.start()
+    if weather_prefetcher.client.base_url:
+        weather_prefetcher.start(graph_registry.bounds())
+
+
+def is_serving_process() -> bool:
+    """
+    With the debug reloader this module also runs in the watching parent process, which never
+    serves requests, only its child started with WERKZEUG_RUN_MAIN does.
+    """
+    return not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
 
 
 if __name__ == '__main__':
-    threading.Thread(target=load_graph, daemon=True).start()
-    app.run(host="0.0.0.0", port=Services.CONTROLLER.port, debug=True)
+    if is_serving_process():
+        threading.Thread(target=pool.fill, daemon=True).start()
+        threading.Thread(target=init_routing, daemon=True).start()
+    app.run(host="0.0.0.0", port=Services.CONTROLLER.port, debug=DEBUG)
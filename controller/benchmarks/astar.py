@@ -0,0 +1,73 @@
+"""
+Settled nodes and latency of Dijkstra vs A* point-to-point searches for typical request distances.
+
+    python -m benchmarks.astar [--snapshot /app/graph/cracow_graph.snapshot] [--queries 50]
+
+Prints one JSON object per (profile, distance) pair.
+"""
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+
+from src.utils.graph import RoutingGraph, WEIGHT_PROFILES, shortest_path
+from .fixtures import grid_graph
+
+
+DISTANCES_M = (1000, 3000, 5000, 10000)
+
+
+def run(graph: RoutingGraph, queries: int, seed: int) -> list[dict]:
+    rnd = random.Random(seed)
+    results = []
+
+    for distance in DISTANCES_M:
+        pairs = []
+        while len(pairs) < queries:
+            source = rnd.randrange(len(graph))
+            distances = graph.distances_to(source)
+            ring = np.flatnonzero(np.abs(distances - distance / 2) < 50)
+            if len(ring):
+                pairs.append((source, int(rnd.choice(ring))))
+
+        for profile in WEIGHT_PROFILES:
+            row = {'profile': profile, 'distance_m': distance, 'queries': queries}
+            for method, heuristic in (('dijkstra', False), ('astar', True)):
+                settled, elapsed = [], []
+                for source, target in pairs:
+                    stats = {}
+                    start = time.perf_counter()
+                    try:
+                        shortest_path(graph, source, target, profile, heuristic=heuristic, stats=stats)
+                    except Exception:
+                        pass
+                    elapsed.append(time.perf_counter() - start)
+                    settled.append(stats['settled'])
+                row[f'{method}_settled_mean'] = float(np.mean(settled))
+                row[f'{method}_ms_mean'] = float(np.mean(elapsed) * 1000)
+            row['settled_ratio'] = row['astar_settled_mean'] / row['dijkstra_settled_mean']
+            results.append(row)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshot', help='Graph snapshot directory, synthetic grid graph is used if omitted')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.snapshot:
+        graph = RoutingGraph.load(args.snapshot)
+    else:
+        graph = RoutingGraph.from_networkx(grid_graph())
+
+    for row in run(graph, args.queries, args.seed):
+        print(json.dumps(row))
+
+
+if __name__ == '__main__':
+    main()
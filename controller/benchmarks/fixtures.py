@@ -0,0 +1,80 @@
+import os
+import random
+
+import numpy as np
+import networkx as nx
+import osmnx as ox
+import geopandas as gpd
+from shapely.geometry import Point
+
+from src.utils.graph import EARTH_RADIUS_M
+
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+KRAKOW_GRAPH_FILEPATH = os.path.join(DATA_DIR, 'krakow_center.graphml')
+KRAKOW_GREEN_FILEPATH = os.path.join(DATA_DIR, 'krakow_center_green.geojson')
+
+
+def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return float(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a)))
+
+
+def grid_graph(size: int = 150, step_m: float = 80.0, center: tuple[float] = (50.0614, 19.9366), seed: int = 0) -> nx.MultiDiGraph:
+    """
+    Synthetic walk graph shaped like the osmnx one: a jittered size x size grid around center (lat, lon)
+    with some streets removed, edge lengths slightly above the straight-line distance and green weights
+    drawn from the multipliers used by add_green_weights_to_graph.
+    """
+    rnd = random.Random(seed)
+    lat_step = np.degrees(step_m / EARTH_RADIUS_M)
+    lon_step = lat_step / np.cos(np.radians(center[0]))
+    south = center[0] - lat_step * size / 2
+    west = center[1] - lon_step * size / 2
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for i in range(size):
+        for j in range(size):
+            graph.add_node(
+                i * size + j,
+                y=south + (i + rnd.uniform(-0.2, 0.2)) * lat_step,
+                x=west + (j + rnd.uniform(-0.2, 0.2)) * lon_step
+            )
+
+    multipliers = [(0.3, 3.0), (0.6, 2.0), (0.8, 1.5), (1.2, 0.8)]
+    for i in range(size):
+        for j in range(size):
+            u = i * size + j
+            for v in ((i + 1) * size + j if i + 1 < size else None, u + 1 if j + 1 < size else None):
+                if v is None or rnd.random() < 0.1:
+                    continue
+                length = haversine(graph.nodes[u]['x'], graph.nodes[u]['y'], graph.nodes[v]['x'], graph.nodes[v]['y'])
+                length *= rnd.uniform(1.0, 1.2)
+                green, avoid_green = rnd.choice(multipliers)
+                for a, b in ((u, v), (v, u)):
+                    graph.add_edge(a, b, length=length, green_weight=length * green, avoid_green_weight=length * avoid_green)
+    return graph
+
+
+def grid_green_areas(graph: nx.MultiDiGraph, count: int = 60, seed: int = 0) -> gpd.GeoDataFrame:
+    """
+    Random round parks over the bounding box of the graph.
+    """
+    rnd = random.Random(seed)
+    xs = [x for _, x in graph.nodes(data='x')]
+    ys = [y for _, y in graph.nodes(data='y')]
+    geometries = [
+        Point(rnd.uniform(min(xs), max(xs)), rnd.uniform(min(ys), max(ys))).buffer(rnd.uniform(0.0005, 0.004))
+        for _ in range(count)
+    ]
+    return gpd.GeoDataFrame(geometry=geometries, crs='epsg:4326')
+
+
+def krakow_fixture() -> tuple[nx.MultiDiGraph, gpd.GeoDataFrame] | None:
+    """
+    Kraków city centre subgraph and its green areas cut by benchmarks.make_fixture, None if not present.
+    """
+    if not (os.path.exists(KRAKOW_GRAPH_FILEPATH) and os.path.exists(KRAKOW_GREEN_FILEPATH)):
+        return None
+    return ox.load_graphml(KRAKOW_GRAPH_FILEPATH), gpd.read_file(KRAKOW_GREEN_FILEPATH)
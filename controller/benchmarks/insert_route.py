@@ -0,0 +1,126 @@
+"""
+WKT vs WKB route geometry for insert_route on long routes.
+
+    python -m benchmarks.insert_route [--points 1000 2000 5000 10000] [--runs 20] [--database]
+
+Always measures client-side encoding time and payload size. With --database, routes are also
+inserted through both paths into a temporary table of the database configured by the DB_*
+variables, with and without encoding (preencoded), and bulk insert of --batch routes is compared
+with inserting them one by one.
+Prints one JSON object per route length.
+"""
+import json
+import time
+import random
+import argparse
+
+import numpy as np
+import psycopg2
+import psycopg2.extras
+
+from src.database import pool
+from src.database.queries import linestring_wkb
+
+
+def linestring_wkt(route) -> str:
+    """
+    Geometry as insert_route built it before WKB.
+    """
+    return 'LINESTRING(' + ', '.join(f'{coords[0]} {coords[1]}' for coords in route) + ')'
+
+
+def random_route(points: int, rnd: random.Random) -> list[tuple[float, float]]:
+    lon, lat = 19.9366, 50.0614
+    coords = []
+    for _ in range(points):
+        lon += rnd.uniform(-1e-4, 1e-4)
+        lat += rnd.uniform(-1e-4, 1e-4)
+        coords.append((lon, lat))
+    return coords
+
+
+def timed_ms(function, runs: int) -> float:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return float(np.median(samples) * 1000)
+
+
+def bench_database(cursor, route: list, runs: int, batch: int) -> dict:
+    wkt = linestring_wkt(route)
+    wkb = psycopg2.Binary(linestring_wkb(route))
+
+    def insert(query: str, geometry):
+        cursor.execute(query, (geometry,))
+
+    results = {
+        'insert_wkt_ms': timed_ms(lambda: insert(
+            'INSERT INTO bench_routes (route) VALUES (ST_GeomFromText(%s, 4326))', linestring_wkt(route)
+        ), runs),
+        'insert_wkb_ms': timed_ms(lambda: insert(
+            'INSERT INTO bench_routes (route) VALUES (ST_GeomFromWKB(%s, 4326))', psycopg2.Binary(linestring_wkb(route))
+        ), runs),
+        'insert_wkt_preencoded_ms': timed_ms(lambda: insert(
+            'INSERT INTO bench_routes (route) VALUES (ST_GeomFromText(%s, 4326))', wkt
+        ), runs),
+        'insert_wkb_preencoded_ms': timed_ms(lambda: insert(
+            'INSERT INTO bench_routes (route) VALUES (ST_GeomFromWKB(%s, 4326))', wkb
+        ), runs),
+    }
+
+    def one_by_one():
+        for _ in range(batch):
+            insert('INSERT INTO bench_routes (route) VALUES (ST_GeomFromWKB(%s, 4326))', psycopg2.Binary(linestring_wkb(route)))
+
+    def bulk():
+        psycopg2.extras.execute_values(
+            cursor, 'INSERT INTO bench_routes (route) SELECT ST_GeomFromWKB(v.route, 4326) FROM (VALUES %s) AS v(route)',
+            [(psycopg2.Binary(linestring_wkb(route)),) for _ in range(batch)], page_size=batch
+        )
+
+    results[f'insert_{batch}_one_by_one_ms'] = timed_ms(one_by_one, max(runs // 4, 1))
+    results[f'insert_{batch}_bulk_ms'] = timed_ms(bulk, max(runs // 4, 1))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--points', type=int, nargs='+', default=[1000, 2000, 5000, 10000])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', action='store_true', help='Also insert into a temporary table of the DB_* database')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    connection = pool.getconn() if args.database else None
+
+    try:
+        if connection is not None:
+            with connection.cursor() as cursor:
+                cursor.execute('CREATE TEMP TABLE bench_routes (route geometry(LINESTRING, 4326))')
+            connection.commit()
+
+        for points in args.points:
+            route = random_route(points, rnd)
+            row = {
+                'points': points,
+                'encode_wkt_ms': timed_ms(lambda: linestring_wkt(route), args.runs),
+                'encode_wkb_ms': timed_ms(lambda: linestring_wkb(route), args.runs),
+                'wkt_bytes': len(linestring_wkt(route).encode()),
+                'wkb_bytes': len(linestring_wkb(route)),
+            }
+            if connection is not None:
+                with connection.cursor() as cursor:
+                    row.update(bench_database(cursor, route, args.runs, args.batch))
+                connection.rollback()
+            print(json.dumps(row))
+    finally:
+        if connection is not None:
+            pool.putconn(connection)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Cut the Kraków benchmark fixture out of the full city graph.
+
+    python -m benchmarks.make_fixture [--graphml /app/graph/cracow_graph.graphml]
+                                      [--green-areas /app/graph/cracow_green.geojson] [--radius 1500]
+
+Writes benchmarks/data/krakow_center.graphml and its green areas as GeoJSON, so the suite runs offline.
+Green areas are clipped from the file written by download_and_save_graph next to the city graph,
+they are fetched from OSM only when it is missing. Nothing is written when that fails.
+"""
+import os
+import argparse
+
+import osmnx as ox
+import geopandas as gpd
+
+from src.utils.algorithm import GRAPH_FILEPATH, GREEN_AREAS_FILEPATH, GREEN_DISTANCE_THRESHOLDS, fetch_green_areas
+from .fixtures import DATA_DIR, KRAKOW_GRAPH_FILEPATH, KRAKOW_GREEN_FILEPATH
+
+
+CENTER = (50.0614, 19.9366)
+
+
+def clip_green_areas(green_areas: gpd.GeoDataFrame, graph) -> gpd.GeoDataFrame:
+    """
+    Green areas within reach of the green weighting of any node of graph.
+    """
+    margin = GREEN_DISTANCE_THRESHOLDS[-1]
+    xs = [x for _, x in graph.nodes(data='x')]
+    ys = [y for _, y in graph.nodes(data='y')]
+    return green_areas.cx[min(xs) - margin:max(xs) + margin, min(ys) - margin:max(ys) + margin]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--graphml', default=GRAPH_FILEPATH)
+    parser.add_argument('--green-areas', default=GREEN_AREAS_FILEPATH, help='Green areas of the city graph')
+    parser.add_argument('--radius', type=float, default=1500, help='Radius in meters around the Main Square')
+    args = parser.parse_args()
+
+    graph = ox.load_graphml(args.graphml)
+    center_node = ox.distance.nearest_nodes(graph, CENTER[1], CENTER[0])
+    subgraph = ox.truncate.truncate_graph_dist(graph, center_node, args.radius, weight='length')
+    for _, _, data in subgraph.edges(data=True):
+        data.pop('green_weight', None)
+        data.pop('avoid_green_weight', None)
+
+    if os.path.exists(args.green_areas):
+        green_areas = clip_green_areas(gpd.read_file(args.green_areas), subgraph)
+    else:
+        print(f'{args.green_areas} not found, fetching green areas from OSM')
+        green_areas = fetch_green_areas(subgraph)
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    ox.save_graphml(subgraph, filepath=KRAKOW_GRAPH_FILEPATH)
+    green_areas[['geometry']].to_file(KRAKOW_GREEN_FILEPATH, driver='GeoJSON')
+    print(f'{len(subgraph)} nodes, {subgraph.number_of_edges()} edges written to {DATA_DIR}')
+
+
+if __name__ == '__main__':
+    main()
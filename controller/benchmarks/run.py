@@ -0,0 +1,180 @@
+"""
+Offline benchmark suite of the graph build and algorithm().
+
+    python -m benchmarks.run [--runs 30] [--grid-size 150] [--output results.json]
+
+Runs on a synthetic grid graph and, when benchmarks.make_fixture has been run, on the Kraków
+centre subgraph. Without it the report has "krakow_center": null and a warning, so such runs are
+not compared with full ones by mistake. For every fixture it measures add_green_weights_to_graph, cold (GraphML) and
+warm (snapshot) load_graph, and algorithm() latency percentiles, retry counters and peak traced
+memory per distance bucket and profile. Results are one JSON document, so runs on different
+commits can be diffed.
+"""
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import argparse
+import platform
+import resource
+import subprocess
+import tracemalloc
+
+import numpy as np
+import osmnx as ox
+
+from src.utils import algorithm as route_algorithm
+from .fixtures import grid_graph, grid_green_areas, krakow_fixture
+
+
+DISTANCES_M = (1000, 3000, 5000, 10000)
+PROFILES = {
+    'length': (False, False),
+    'green_weight': (True, False),
+    'avoid_green_weight': (False, True),
+}
+
+
+def timed(function, *args, **kwargs) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def percentiles(samples: list[float]) -> dict[str, float]:
+    ms = np.asarray(samples) * 1000
+    return {
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def bench_build(graph, green_areas, workdir: str) -> dict:
+    for _, _, data in graph.edges(data=True):
+        data.pop('green_weight', None)
+        data.pop('avoid_green_weight', None)
+
+    green_seconds, _ = timed(route_algorithm.add_green_weights_to_graph, graph, green_areas)
+
+    graph_filepath = os.path.join(workdir, 'graph.graphml')
+    snapshot_filepath = os.path.join(workdir, 'graph.snapshot')
+    ox.save_graphml(graph, filepath=graph_filepath)
+
+    cold_seconds, _ = timed(route_algorithm.load_graph, graph_filepath, snapshot_filepath)
+    warm_seconds, _ = timed(route_algorithm.load_graph, graph_filepath, snapshot_filepath)
+
+    return {
+        'nodes': graph.number_of_nodes(),
+        'edges': graph.number_of_edges(),
+        'green_areas': len(green_areas),
+        'add_green_weights_s': green_seconds,
+        'load_graph_graphml_s': cold_seconds,
+        'load_graph_snapshot_s': warm_seconds,
+    }
+
+
+def bench_algorithm(runs: int, seed: int) -> list[dict]:
+    routing_graph = route_algorithm.R
+    rnd = random.Random(seed)
+    starts = [
+        (float(routing_graph.y[node]), float(routing_graph.x[node]))
+        for node in (rnd.randrange(len(routing_graph)) for _ in range(runs))
+    ]
+    results = []
+
+    for distance in DISTANCES_M:
+        for profile, (is_prefer_green, is_avoid_green) in PROFILES.items():
+            latencies, failures, real_distances = [], 0, []
+            counters = {'general_retries': 0, 'return_path_retries': 0, 'reverse_path_fallbacks': 0}
+
+            for run, start in enumerate(starts):
+                stats = {}
+                elapsed, (coords, real_distance) = timed(
+                    route_algorithm.algorithm, start, distance, is_prefer_green, is_avoid_green, seed=run, stats=stats
+                )
+                latencies.append(elapsed)
+                if coords is None:
+                    failures += 1
+                else:
+                    real_distances.append(real_distance)
+                for name in counters:
+                    counters[name] += stats.get(name, 0)
+
+            tracemalloc.start()
+            route_algorithm.algorithm(starts[0], distance, is_prefer_green, is_avoid_green, seed=0)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results.append({
+                'distance_m': distance,
+                'profile': profile,
+                'runs': runs,
+                'failures': failures,
+                **percentiles(latencies),
+                'distance_error_mean': float(np.mean(np.abs(np.asarray(real_distances) - distance) / distance))
+                    if real_distances else None,
+                **counters,
+                'peak_traced_kb': peak / 1024,
+            })
+
+    return results
+
+
+def current_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=30, help='algorithm() calls per distance bucket and profile')
+    parser.add_argument('--grid-size', type=int, default=150)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write results to this file instead of stdout')
+    args = parser.parse_args()
+
+    grid = grid_graph(args.grid_size, seed=args.seed)
+    fixtures = {'grid': (grid, grid_green_areas(grid, seed=args.seed))}
+    krakow = krakow_fixture()
+    if krakow is not None:
+        fixtures['krakow_center'] = krakow
+
+    report = {
+        'commit': current_commit(),
+        'python': platform.python_version(),
+        'fixtures': {},
+        'warnings': [],
+    }
+    if krakow is None:
+        warning = 'krakow_center fixture missing, run python -m benchmarks.make_fixture'
+        report['fixtures']['krakow_center'] = None
+        report['warnings'].append(warning)
+        print(f'Warning: {warning}', file=sys.stderr)
+
+    for name, (graph, green_areas) in fixtures.items():
+        with tempfile.TemporaryDirectory() as workdir:
+            build = bench_build(graph, green_areas, workdir)
+            report['fixtures'][name] = {
+                'build': build,
+                'algorithm': bench_algorithm(args.runs, args.seed),
+            }
+
+    report['max_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -10,16 +10,19 @@ from flask_cors import CORS
 from .utils.logger_config import config_logger
 from .utils.limiter import configure_limiter
 from .utils.cache import configure_cache
+from .utils.metrics import configure_metrics
 
 app = Flask(__name__)
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)
+app.config['ERROR_404_HELP'] = False
 
 CORS(app)
 config_logger(app, DEBUG)
 JWTManager(app)
 configure_limiter(app)
 configure_cache(app)
+configure_metrics(app)
 
 blueprint = Blueprint('api', __name__)
 api = Api(blueprint, version = '1.0.0', title = 'PetWalk Controller API')
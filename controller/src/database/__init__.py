@@ -1,51 +1,220 @@
 import os
+import time
 import logging
+import threading
+from contextlib import contextmanager
 
 import psycopg2
 import psycopg2.extras
 
+from ..utils.metrics import db_pool_wait_seconds, db_pool_checkout_timeouts
+
 
 log = logging.getLogger('DATABASE')
 
 
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Process-wide thread-safe pool of database connections. At least `min_size` connections are
+    kept open and at most `max_size` are opened, checkouts wait up to `timeout` seconds for a free
+    one. Connections idle for more than `health_check_after` seconds are checked with SELECT 1
+    on checkout and replaced when broken.
+    """
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, health_check_after: float, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.connect_kwargs = connect_kwargs
+        self._idle: list[tuple[object, float]] = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def _open(self):
+        connection = psycopg2.connect(**self.connect_kwargs)
+        log.info("Connected to the database")
+        return connection
+
+    def _close(self, connection) -> None:
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _is_healthy(self, connection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def fill(self) -> None:
+        """
+        Open connections up to min_size.
+        """
+        while True:
+            with self._condition:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                connection = self._open()
+            except psycopg2.Error as e:
+                with self._condition:
+                    self._size -= 1
+                log.info(f"Error connecting to the database: {e}")
+                return
+            self.putconn(connection)
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        db_pool_checkout_timeouts.inc()
+                        raise PoolTimeout(f'No database connection free within {self.timeout}s')
+                    self._condition.wait(remaining)
+
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                else:
+                    connection, idle_since = None, None
+                    self._size += 1
+
+            if connection is not None and self._is_healthy(connection, idle_since):
+                db_pool_wait_seconds.observe(time.monotonic() - start)
+                return connection
+
+            if connection is not None:
+                log.warning("Replacing broken database connection")
+                self._close(connection)
+            try:
+                connection = self._open()
+            except psycopg2.Error:
+                with self._condition:
+                    self._size -= 1
+                    self._condition.notify()
+                raise
+            db_pool_wait_seconds.observe(time.monotonic() - start)
+            return connection
+
+    def putconn(self, connection) -> None:
+        if not connection.closed and connection.status != psycopg2.extensions.STATUS_READY:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                self._close(connection)
+
+        with self._condition:
+            if connection.closed:
+                self._size -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+    def stats(self) -> dict[str, int]:
+        with self._condition:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+            }
+
+
+pool = ConnectionPool(
+    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 1)),
+    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 10)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    health_check_after=float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30)),
+    host=os.environ.get('DB_HOST'),
+    port=os.environ.get('DB_PORT'),
+    user=os.environ.get('DB_USER'),
+    password=os.environ.get('DB_PASSWORD'),
+    database=os.environ.get('DB_NAME'),
+    connect_timeout=int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+)
+
+
 class PostgresConnect:
+    """
+    Runs queries on connections of the process-wide pool. Every query checks a connection out
+    and returns it once committed, unless one is held between connect() and disconnect().
+    """
+
     def __init__(self):
-        self.host = os.environ.get('DB_HOST')
-        self.port = os.environ.get('DB_PORT')
-        self.user = os.environ.get('DB_USER')
-        self.password = os.environ.get('DB_PASSWORD')
-        self.database = os.environ.get('DB_NAME')
         self.connection = None
 
     def connect(self):
         try:
-            self.connection = psycopg2.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.password,
-                database=self.database
-            )
-            log.info("Connected to the database")
-        except psycopg2.Error as e:
+            self.connection = pool.getconn()
+        except (psycopg2.Error, PoolTimeout) as e:
             log.info(f"Error connecting to the database: {e}")
 
     def disconnect(self):
         if self.connection:
-            self.connection.close()
-            log.info("Disconnected from the database.")
+            pool.putconn(self.connection)
+            self.connection = None
 
-    def execute_query(self, query, params=None):
-        if not self.connection:
-            self.connect()
+    def execute_query(self, query, params=None, execute=None):
+        if self.connection:
+            return self._execute(self.connection, query, params, execute)
         try:
-            cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            self.connection.commit()
-            return cursor.fetchall()
+            with pool.connection() as connection:
+                return self._execute(connection, query, params, execute)
+        except (psycopg2.Error, PoolTimeout) as e:
+            log.info(f"Error connecting to the database: {e}")
+            return None
+
+    def execute_values(self, query, values, template=None):
+        """
+        Run a query with a VALUES %s placeholder expanded to all rows of values in one statement.
+        """
+        return self.execute_query(query, (values, template), execute=self._execute_values)
+
+    @staticmethod
+    def _execute_values(cursor, query, params):
+        values, template = params
+        psycopg2.extras.execute_values(cursor, query, values, template, page_size=len(values))
+
+    def _execute(self, connection, query, params=None, execute=None):
+        try:
+            with connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                if execute:
+                    execute(cursor, query, params)
+                elif params:
+                    cursor.execute(query, params)
+                else:
+                    cursor.execute(query)
+                connection.commit()
+                return cursor.fetchall()
         except psycopg2.Error as e:
             log.info(f"Error executing query: {e}")
+            if not connection.closed:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    pass
             return None
@@ -1,10 +1,29 @@
+import math
+import struct
 import logging
+from collections import Counter
+
+import numpy as np
+import psycopg2
 
 from . import PostgresConnect
+from ..utils.graph import EARTH_RADIUS_M
 
 
 log = logging.getLogger('QUERIES')
 
+MAX_ROUTES_PER_USER = 10
+WKB_LINESTRING_HEADER = struct.Struct('<BII')
+WKB_LINESTRING = 2
+
+
+def linestring_wkb(coords) -> bytes:
+    """
+    Little-endian WKB LineString of (lon, lat) coordinates.
+    """
+    coords = np.ascontiguousarray(coords, dtype='<f8').reshape(-1, 2)
+    return WKB_LINESTRING_HEADER.pack(1, WKB_LINESTRING, len(coords)) + coords.tobytes()
+
 
 class Queries(PostgresConnect):
 
@@ -157,33 +176,111 @@ class Queries(PostgresConnect):
             log.error(f"Error updating profile picture for user {user_id}: {e}")
             return False
 
-    def get_routes_by_user_id(self, user_id: int) -> list:
+    def get_routes_page_by_user_id(
+        self,
+        user_id: int,
+        limit: int,
+        after: tuple | None = None,
+        with_geometry: bool = True,
+        max_decimal_digits: int = 9
+    ) -> list:
         """
-        Retrieve all routes associated with a specific user.
+        Retrieve a page of routes of a user, newest first. `after` is the (timestamp, id) of the
+        last route of the previous page. Every row holds the route output as JSON text built by
+        the database, with the geometry limited to max_decimal_digits or left out.
         """
-        query = """
+        keyset = 'AND "timestamp" <= %(timestamp)s AND ("timestamp", id) < (%(timestamp)s, %(id)s)' if after else ''
+        query = f"""
             SELECT
                 id,
-                user_id,
-                declared_distance,
-                real_distance,
-                is_avoid_green,
-                is_prefer_green,
-                is_include_weather,
-                ST_AsGeoJSON(start_point) AS point,
-                ST_AsGeoJSON(route) AS route,
-                timestamp
+                "timestamp",
+                json_build_object(
+                    'id', id,
+                    'route', CASE WHEN %(with_geometry)s THEN ST_AsGeoJSON(route, %(max_decimal_digits)s)::json END,
+                    'declared_parameters', json_build_object(
+                        'point', json_build_object('latitude', ST_Y(start_point), 'longitude', ST_X(start_point)),
+                        'declared_distance', declared_distance,
+                        'is_prefer_green', is_prefer_green,
+                        'is_avoid_green', is_avoid_green,
+                        'is_include_weather', is_include_weather
+                    ),
+                    'real_distance', real_distance,
+                    'timestamp', "timestamp"::text
+                )::text AS json
             FROM routes
-            WHERE user_id = %s
+            WHERE user_id = %(user_id)s {keyset}
+            ORDER BY "timestamp" DESC, id DESC
+            LIMIT %(limit)s
         """
-        rows = self.execute_query(query, (user_id,))
+        params = {
+            'user_id': user_id,
+            'limit': limit,
+            'with_geometry': with_geometry,
+            'max_decimal_digits': max_decimal_digits,
+        }
+        if after:
+            params['timestamp'], params['id'] = after
+        rows = self.execute_query(query, params)
         return rows if rows else []
 
-    def insert_route(self, route_dict: dict) -> dict[str, int | str] | None:
+    def find_nearby_route(
+        self,
+        latitude: float,
+        longitude: float,
+        declared_distance: int,
+        is_prefer_green: bool,
+        is_avoid_green: bool,
+        radius_m: float,
+        distance_tolerance: float
+    ) -> dict | None:
         """
-        Create a new route using ST_GeomFromText to insert geometry.
+        Retrieve the saved route starting nearest to the point within radius_m meters, generated
+        with the same green preference and with real distance within distance_tolerance of the
+        declared one. Routes fitted to the weather and routes of private users are not considered.
+        The bounding box in degrees lets the start_point index prefilter the exact distance check.
         """
         query = """
+            SELECT
+                routes.id,
+                routes.user_id,
+                routes.real_distance,
+                ST_AsGeoJSON(routes.route)::json AS route,
+                routes."timestamp"
+            FROM routes
+            JOIN users ON users.id = routes.user_id
+            WHERE ST_DWithin(routes.start_point, ST_SetSRID(ST_MakePoint(%(longitude)s, %(latitude)s), 4326), %(radius_deg)s)
+                AND ST_DWithin(
+                    routes.start_point::geography,
+                    ST_SetSRID(ST_MakePoint(%(longitude)s, %(latitude)s), 4326)::geography,
+                    %(radius_m)s
+                )
+                AND routes.is_include_weather IS NOT TRUE
+                AND routes.is_prefer_green = %(is_prefer_green)s
+                AND routes.is_avoid_green = %(is_avoid_green)s
+                AND routes.real_distance BETWEEN %(min_distance)s AND %(max_distance)s
+                AND users.is_private IS NOT TRUE
+            ORDER BY routes.start_point <-> ST_SetSRID(ST_MakePoint(%(longitude)s, %(latitude)s), 4326)
+            LIMIT 1
+        """
+        rows = self.execute_query(query, {
+            'latitude': latitude,
+            'longitude': longitude,
+            'radius_m': radius_m,
+            'radius_deg': math.degrees(radius_m / EARTH_RADIUS_M) / max(math.cos(math.radians(latitude)), 1e-6),
+            'is_prefer_green': is_prefer_green,
+            'is_avoid_green': is_avoid_green,
+            'min_distance': declared_distance * (1 - distance_tolerance),
+            'max_distance': declared_distance * (1 + distance_tolerance),
+        })
+        if rows:
+            return dict(rows[0])
+
+    def insert_route(self, route_dict: dict) -> dict[str, int | str] | None:
+        """
+        Create a new route, the geometry is sent as WKB. The user row is locked while its route
+        count, kept by the routes trigger, is checked against the limit.
+        """
+        query = f"""
             INSERT INTO routes (
                 user_id,
                 declared_distance,
@@ -195,18 +292,17 @@ class Queries(PostgresConnect):
                 route
             )
             SELECT
-                %s, %s, %s, %s, %s, %s,
+                users.id, %s, %s, %s, %s, %s,
                 ST_SetSRID(ST_MakePoint(%s, %s), 4326),
-                ST_GeomFromText(%s, 4326)
-            WHERE (
-                SELECT COUNT(*) FROM routes WHERE user_id = %s
-            ) < 10
+                ST_GeomFromWKB(%s, 4326)
+            FROM users
+            WHERE users.id = %s AND users.route_count < {MAX_ROUTES_PER_USER}
+            FOR UPDATE OF users
             RETURNING id, timestamp;
         """
         rows = self.execute_query(
             query,
             (
-                route_dict['user_id'],
                 route_dict['declared_distance'],
                 route_dict['real_distance'],
                 route_dict['is_avoid_green'],
@@ -214,24 +310,77 @@ class Queries(PostgresConnect):
                 route_dict['is_include_weather'],
                 route_dict['longitude'],
                 route_dict['latitude'],
-                'LINESTRING(' + ', '.join(f'{coords[0]} {coords[1]}' for coords in route_dict['route']) + ')',
+                psycopg2.Binary(linestring_wkb(route_dict['route'])),
                 route_dict['user_id'],
             )
         )
         if rows:
             return rows[0]
-        
+
+    def insert_routes(self, route_dicts: list[dict]) -> list[dict[str, int | str]]:
+        """
+        Create many routes in one statement, the geometries are sent as WKB. Routes over the
+        per-user limit are skipped, returns id and timestamp of the inserted ones. Rows of the
+        users are locked as in insert_route.
+        """
+        if not route_dicts:
+            return []
+
+        query = f"""
+            INSERT INTO routes (
+                user_id,
+                declared_distance,
+                real_distance,
+                is_avoid_green,
+                is_prefer_green,
+                is_include_weather,
+                start_point,
+                route
+            )
+            SELECT
+                v.user_id, v.declared_distance, v.real_distance, v.is_avoid_green, v.is_prefer_green, v.is_include_weather,
+                ST_SetSRID(ST_MakePoint(v.longitude, v.latitude), 4326),
+                ST_GeomFromWKB(v.route, 4326)
+            FROM (VALUES %s) AS v(
+                ordinal, user_id, declared_distance, real_distance, is_avoid_green, is_prefer_green, is_include_weather,
+                longitude, latitude, route, user_rank
+            )
+            JOIN users ON users.id = v.user_id
+            WHERE users.route_count + v.user_rank <= {MAX_ROUTES_PER_USER}
+            ORDER BY v.ordinal
+            FOR UPDATE OF users
+            RETURNING id, timestamp;
+        """
+        user_ranks = Counter()
+        values = []
+        for ordinal, route_dict in enumerate(route_dicts):
+            user_ranks[route_dict['user_id']] += 1
+            values.append((
+                ordinal,
+                route_dict['user_id'],
+                route_dict['declared_distance'],
+                route_dict['real_distance'],
+                route_dict['is_avoid_green'],
+                route_dict['is_prefer_green'],
+                route_dict['is_include_weather'],
+                route_dict['longitude'],
+                route_dict['latitude'],
+                psycopg2.Binary(linestring_wkb(route_dict['route'])),
+                user_ranks[route_dict['user_id']],
+            ))
+
+        template = '(%s, %s::int, %s::int, %s::int, %s::boolean, %s::boolean, %s::boolean, ' \
+                   '%s::float8, %s::float8, %s::bytea, %s)'
+        rows = self.execute_values(query, values, template)
+        return rows if rows else []
+
     def delete_route(self, route_id: int, user_id: str) -> bool:
         """
         Route deletion
         """
         query = """
             DELETE FROM routes
-            WHERE id IN (
-                SELECT id FROM routes
-                WHERE id = %s AND user_id = %s
-                LIMIT 1
-            )
+            WHERE id = %s AND user_id = %s
             RETURNING id;
         """
         result = self.execute_query(query, (route_id, user_id))
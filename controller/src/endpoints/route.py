@@ -1,16 +1,28 @@
+import os
 import logging
 import json
+import base64
+import random
 from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
 
-from flask import request
-from flask_restx import Resource, fields, Namespace
+from flask import request, Response
+from flask_restx import Resource, fields, Namespace, marshal
 from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request, jwt_required
 
 from ..database.queries import Queries as db
 from ..utils.limiter import limiter, LimitFunc
 from ..utils.cache import cache
-from ..utils.algorithm import algorithm
-from ..utils.weather import get_weather_info
+from ..utils.route_engine import route_engine, RouteEngineSaturated
+from ..utils.jobs import route_jobs, JobStatus
+from ..utils.route_cache import route_cache
+from ..utils.algorithm import snap_point
+from ..utils.simplify import simplify_route
+from ..utils.metrics import observe_stage, observe_algorithm_stats, route_request_seconds
+from ..utils.tiles import OutsideRegionsError
+from ..utils.request import send_request
+from ..utils.apps import Services
+from ..utils.weather import weather_prefetcher
 from ..utils import scrap
 
 
@@ -18,6 +30,15 @@ log = logging.getLogger('ROUTE')
 
 api = Namespace('route')
 
+SIMPLIFY_TOLERANCE_M = float(os.environ.get('ROUTE_SIMPLIFY_TOLERANCE_M', 1.0))
+ROUTE_PAGE_SIZE = int(os.environ.get('ROUTE_PAGE_SIZE', 20))
+ROUTE_PAGE_MAX_SIZE = int(os.environ.get('ROUTE_PAGE_MAX_SIZE', 100))
+ROUTE_MAX_DECIMAL_DIGITS = 9
+REUSE_RADIUS_M = float(os.environ.get('ROUTE_REUSE_RADIUS_M', 100))
+REUSE_DISTANCE_TOLERANCE = float(os.environ.get('ROUTE_REUSE_DISTANCE_TOLERANCE', 0.1))
+
+_job_callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='route-jobs')
+
 point_model = api.model('RoutePointModel', {
     'latitude': fields.Float(description="Latitude coordinate"),
     'longitude': fields.Float(description="Longitude coordinate")
@@ -44,8 +65,39 @@ route_model = api.model('Route', {
     'timestamp': fields.String(description="Timestamp of the route generation", example="2024-12-05 21:18:07"),
 })
 
+weather_model = api.model('RouteWeather', {
+    'rain_past_6h': fields.Boolean(description="Whether it rained in the past 6 hours", example=False),
+    'rain_next_2h': fields.Boolean(description="Whether rain is forecast for the next 2 hours", example=False),
+    'is_stale': fields.Boolean(description="Whether the weather data is older than its refresh period", example=False),
+})
+
+alternative_route_model = api.model('AlternativeRoute', {
+    'route': fields.Nested(route_obj_model),
+    'real_distance': fields.Integer(description="Real calculated distance of the route in meters", example=1000),
+})
+
+generated_route_model = api.inherit('GeneratedRoute', route_model, {
+    'alternatives': fields.List(fields.Nested(alternative_route_model), description="Further ranked alternative routes, not saved"),
+    'weather': fields.Nested(weather_model, allow_null=True, description="Weather the route was fitted to, when included"),
+})
+
+route_post_model = api.inherit('RoutePostParameters', declared_parameters_model, {
+    'alternatives': fields.Integer(description="Number of ranked alternative routes to generate", example=1, min=1, max=5),
+    'seed': fields.Integer(description="Seed of the route generation, same parameters and seed give the same route", example=0, min=0),
+    'simplify_tolerance_m': fields.Float(description="Tolerance in meters of the route geometry simplification, 0 disables it", example=1.0, min=0),
+    'reuse': fields.Boolean(description="Whether a saved route starting nearby with matching parameters may be returned instead of generating one", example=False),
+})
+
+route_job_model = api.model('RouteJob', {
+    'id': fields.String(description="Unique ID of the job", example="4f2a0c9e1b7d4e5f8a6b3c2d1e0f9a8b"),
+    'status': fields.String(description="Status of the job", enum=[JobStatus.PENDING, JobStatus.DONE, JobStatus.FAILED]),
+    'result': fields.Nested(generated_route_model, allow_null=True, description="Generated route once done"),
+    'error': fields.String(description="Reason of the failure"),
+})
+
 route_list_model = api.model('RoutesList', {
-    'routes': fields.List(fields.Nested(route_model), description="List of routes")
+    'routes': fields.List(fields.Nested(route_model), description="List of routes, newest first"),
+    'next_cursor': fields.String(description="Cursor of the next page, null on the last page"),
 })
 
 delete_route_model = api.model('DeleteRoute', {
@@ -53,6 +105,16 @@ delete_route_model = api.model('DeleteRoute', {
 })
 
 
+@api.errorhandler(RouteEngineSaturated)
+def handle_route_engine_saturated(error):
+    return {'message': 'Route generation is busy, try again later'}, 503, {'Retry-After': str(error.retry_after)}
+
+
+@api.errorhandler(OutsideRegionsError)
+def handle_outside_regions(error):
+    return {'message': 'Point is outside of the served area'}, 404
+
+
 @api.route('/')
 class Route(Resource):
     @api.doc(params={
@@ -63,32 +125,48 @@ class Route(Resource):
             'default': 'Bearer '
         }
     })
-    @api.response(200, "OK")
+    @api.doc(params={
+        'limit': {'description': f'Number of routes of the page, at most {ROUTE_PAGE_MAX_SIZE}', 'type': 'integer', 'default': ROUTE_PAGE_SIZE},
+        'cursor': {'description': 'next_cursor of the previous page', 'type': 'string'},
+        'geometry': {'description': 'Whether to include the route geometry', 'type': 'boolean', 'default': True},
+        'precision': {'description': 'Decimal digits of the route coordinates', 'type': 'integer', 'default': ROUTE_MAX_DECIMAL_DIGITS},
+    })
+    @api.response(200, "OK", route_list_model)
+    @api.response(400, "Bad Request")
     @api.response(500, "Internal Server Error")
-    @api.marshal_with(route_list_model, code=200)
     @jwt_required()
     def get(self):
         """
-        Fetch routes based on user_id
+        Fetch a page of routes based on user_id
         """
         user_id = get_jwt_identity()
 
+        try:
+            limit = int(request.args.get('limit', ROUTE_PAGE_SIZE))
+            precision = int(request.args.get('precision', ROUTE_MAX_DECIMAL_DIGITS))
+            after = decode_route_cursor(request.args['cursor']) if request.args.get('cursor') else None
+        except ValueError:
+            api.abort(400, 'Invalid limit, precision or cursor')
+
+        if not 1 <= limit <= ROUTE_PAGE_MAX_SIZE or not 0 <= precision <= ROUTE_MAX_DECIMAL_DIGITS:
+            api.abort(400, f'Limit must be within 1-{ROUTE_PAGE_MAX_SIZE} and precision within 0-{ROUTE_MAX_DECIMAL_DIGITS}')
+
         queries = db()
 
-        data = queries.get_routes_by_user_id(user_id)
+        rows = queries.get_routes_page_by_user_id(
+            user_id,
+            limit + 1,
+            after=after,
+            with_geometry=request.args.get('geometry', 'true').lower() not in ('false', '0'),
+            max_decimal_digits=precision
+        )
 
-        for dct in data:
-            p_coords = json.loads(dct.pop('point'))['coordinates']
-            dct['declared_parameters'] = {
-                'point': {'latitude': p_coords[1], 'longitude': p_coords[0]},
-                'declared_distance': dct.pop('declared_distance'),
-                'is_avoid_green': dct.pop('is_avoid_green'),
-                'is_prefer_green': dct.pop('is_prefer_green'),
-                'is_include_weather': dct.pop('is_include_weather'),
-            }
-            dct['route'] = json.loads(dct.pop('route'))
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_route_cursor(rows[-1]['timestamp'], rows[-1]['id'])
 
-        return {'routes': data}
+        return Response(stream_route_page(rows, next_cursor), mimetype='application/json')
     
     @api.doc(params={
         'Authorization': {
@@ -126,104 +204,334 @@ class Route(Resource):
             'default': 'Bearer '
         }
     })
-    @api.expect(declared_parameters_model, validate=True)
-    @api.marshal_with(route_model, code=200)
+    @api.expect(route_post_model, validate=True)
+    @api.marshal_with(generated_route_model, code=200)
     @api.response(200, 'OK')
     @api.response(400, "Bad Request")
     @api.response(404, "Not found")
     @api.response(500, "Internal Server Error")
+    @api.response(503, "Route generation busy, retry after the Retry-After header")
+    @api.response(504, "Route generation timed out")
     @limiter.limit(LimitFunc.limit_logged_users_routes_post)
+    @route_request_seconds.time()
     def post(self):
         """
         Generate a new route based on parameters
         """
-        json = request.json
+        params = parse_route_parameters(request.json)
+        cache_key, args, kwargs = prepare_algorithm_call(params)
 
-        point = json.get('point', {})
-        latitude = point.get('latitude', 0.0)
-        longitude = point.get('longitude', 0.0)
-        declared_distance = json.get('declared_distance', 1000)
-        is_prefer_green = json.get('is_prefer_green', False)
-        is_avoid_green = json.get('is_avoid_green', False)
-        is_include_weather = json.get('is_include_weather', False)
+        with observe_stage('cache_lookup'):
+            loops = route_cache.get(cache_key)
 
-        is_rainy: bool = False
-        
-        if is_include_weather:
+        if loops is None and params['reuse']:
+            loops = find_reusable_route(params, args)
+
+        if loops is None:
             try:
-                weather_conditions = get_weather_info(latitude, longitude)
-                log.info(f"Weather conditions at ({latitude}, {longitude}): {weather_conditions}")
-                is_rainy = any(weather_conditions.values())
-            except Exception as e:
-                log.error(f"WeatherAPI error: {str(e)}")
-        
-        coords, real_distance = algorithm(
-            (latitude, longitude), 
-            declared_distance, 
-            is_prefer_green if not is_include_weather else not is_rainy, 
-            is_avoid_green if not is_include_weather else is_rainy
-        )
+                loops = route_engine.run(*args, **kwargs)
+            except TimeoutError:
+                log.error(f"Route generation timed out for {params['point']}, {params['declared_distance'] = }")
+                api.abort(504, 'Route generation timed out')
 
-        if not coords:
+            if loops:
+                route_cache.put(cache_key, loops)
+
+        if not loops:
             api.abort(500)
 
-        route_id = ''
-        timestamp = ''
-        user_id = None
+        output_json = save_route(loops, params, get_optional_user_id())
 
-        try:
-            verify_jwt_in_request()
-            user_id = get_jwt_identity()
-        except:
-            pass
-        
-        if user_id:
-            queries = db()
-
-            route_data = {
-                "route": coords,
-                "latitude": latitude,
-                "longitude": longitude,
-                "real_distance": real_distance,
-                "declared_distance": declared_distance,
-                "is_prefer_green": is_prefer_green,
-                "is_avoid_green": is_avoid_green,
-                "is_include_weather": is_include_weather,
-                "user_id": user_id
-            }
+        if not output_json:
+            api.abort(500)
 
-            result = queries.insert_route(route_data)
+        return output_json, 200
 
-            if not result:
-                api.abort(500)
-                
-            route_id = result['id']
-            timestamp = result['timestamp']
-        
+
+@api.route('/jobs')
+class RouteJobs(Resource):
+    @api.doc(params={
+        'Authorization': {
+            'description': 'Bearer token for authentication, result is pushed through the notifier when given',
+            'required': False,
+            'in': 'header',
+            'default': 'Bearer '
+        }
+    })
+    @api.expect(route_post_model, validate=True)
+    @api.marshal_with(route_job_model, code=202)
+    @api.response(202, 'Accepted')
+    @api.response(400, "Bad Request")
+    @api.response(404, "Not found")
+    @api.response(503, "Route generation busy, retry after the Retry-After header")
+    @limiter.limit(LimitFunc.limit_logged_users_routes_post)
+    def post(self):
+        """
+        Start generating a new route in the background, poll GET /route/jobs/<id> or wait for route_ready event
+        """
+        params = parse_route_parameters(request.json)
+        user_id = get_optional_user_id()
+
+        cache_key, args, kwargs = prepare_algorithm_call(params)
+        loops = route_cache.get(cache_key)
+
+        if loops is None and params['reuse']:
+            loops = find_reusable_route(params, args)
+            if loops is not None:
+                cache_key = None
+
+        job = route_jobs.create(user_id)
+        if job is None:
+            raise RouteEngineSaturated(route_engine.retry_after)
+
+        if loops is not None:
+            future = Future()
+            future.set_result(loops)
         else:
-            route_id = -1
-            timestamp = datetime.now()
-        
-        output_json = {
-            "id": route_id,
-            "route": {
-                'type': 'LineString',
-                'coordinates': coords,
-            },   
+            try:
+                future = route_engine.submit(*args, **kwargs)
+            except BaseException:
+                route_jobs.remove(job.id)
+                raise
+
+        future.add_done_callback(
+            lambda future: _job_callbacks.submit(complete_route_job, job.id, params, user_id, future, cache_key)
+        )
+
+        return job, 202
+
+
+@api.route('/jobs/<string:job_id>')
+class RouteJob(Resource):
+    @api.marshal_with(route_job_model, code=200)
+    @api.response(200, 'OK')
+    @api.response(404, "Not found")
+    def get(self, job_id):
+        """
+        Fetch status and result of a route job
+        """
+        job = route_jobs.get(job_id)
+
+        if not job or (job.user_id and str(job.user_id) != str(get_optional_user_id())):
+            api.abort(404, 'Job not found')
+
+        return job, 200
+
+
+def get_optional_user_id():
+    try:
+        verify_jwt_in_request()
+        return get_jwt_identity()
+    except:
+        return None
+
+
+def encode_route_cursor(timestamp: datetime, route_id: int) -> str:
+    return base64.urlsafe_b64encode(f'{timestamp.isoformat()}|{route_id}'.encode()).decode()
+
+
+def decode_route_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    (timestamp, id) of a cursor, raises ValueError when malformed.
+    """
+    try:
+        timestamp, route_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f'Invalid cursor {cursor}') from e
+    return datetime.fromisoformat(timestamp), int(route_id)
+
+
+def stream_route_page(rows: list[dict], next_cursor: str | None):
+    """
+    Route list response written from the JSON text of the rows, without parsing it.
+    """
+    yield '{"routes": ['
+    for index, row in enumerate(rows):
+        yield ', ' + row['json'] if index else row['json']
+    yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
+
+
+def parse_route_parameters(json_data: dict) -> dict:
+    point = json_data.get('point', {})
+    return {
+        'point': {
+            'latitude': point.get('latitude', 0.0),
+            'longitude': point.get('longitude', 0.0),
+        },
+        'declared_distance': json_data.get('declared_distance', 1000),
+        'is_prefer_green': json_data.get('is_prefer_green', False),
+        'is_avoid_green': json_data.get('is_avoid_green', False),
+        'is_include_weather': json_data.get('is_include_weather', False),
+        'alternatives': json_data.get('alternatives', 1),
+        'seed': json_data.get('seed'),
+        'simplify_tolerance_m': json_data.get('simplify_tolerance_m', SIMPLIFY_TOLERANCE_M),
+        'reuse': json_data.get('reuse', False),
+    }
+
+
+def prepare_algorithm_call(params: dict) -> tuple[tuple, tuple, dict]:
+    """
+    Cache key and algorithm() arguments for the declared parameters. Green preference is replaced
+    by the prefetched weather when it should be included, the start point is snapped to its graph node
+    and the distance is quantized, so a cached result is exactly what a fresh computation returns.
+    The weather used is stored in params['weather'].
+    """
+    latitude = params['point']['latitude']
+    longitude = params['point']['longitude']
+    is_prefer_green = params['is_prefer_green']
+    is_avoid_green = params['is_avoid_green']
+
+    params['weather'] = None
+    if params['is_include_weather']:
+        with observe_stage('weather'):
+            weather = weather_prefetcher.lookup(latitude, longitude)
+        log.info(f"Weather conditions at ({latitude}, {longitude}): {weather}")
+        if weather is not None:
+            is_rainy = weather['rain_past_6h'] or weather['rain_next_2h']
+            is_prefer_green, is_avoid_green = not is_rainy, is_rainy
+            params['weather'] = weather
+        else:
+            log.warning(f"No weather prefetched for ({latitude}, {longitude}), using declared parameters")
+
+    stats = {}
+    with observe_stage('snap_start'):
+        start_node, start_point = snap_point((latitude, longitude), stats)
+    observe_algorithm_stats(stats)
+    distance = route_cache.quantize_distance(params['declared_distance'])
+    seed = params['seed'] if params['seed'] is not None else random.randrange(route_cache.seeds)
+
+    key = route_cache.key(start_node, distance, is_prefer_green, is_avoid_green, seed, params['alternatives'])
+    args = (start_point, distance, is_prefer_green, is_avoid_green)
+    kwargs = {'alternatives': params['alternatives'], 'seed': seed}
+    return key, args, kwargs
+
+
+def find_reusable_route(params: dict, args: tuple) -> list[tuple] | None:
+    """
+    Loops holding a saved route which starts near the declared point with the green preference
+    algorithm() would be called with, None when there is none. The route found is stored in
+    params['reused_route'].
+    """
+    _, _, is_prefer_green, is_avoid_green = args
+    with observe_stage('reuse_lookup'):
+        route = db().find_nearby_route(
+            params['point']['latitude'],
+            params['point']['longitude'],
+            params['declared_distance'],
+            is_prefer_green,
+            is_avoid_green,
+            REUSE_RADIUS_M,
+            REUSE_DISTANCE_TOLERANCE
+        )
+    params['reused_route'] = route
+    if not route:
+        return None
+    log.info(f"Reusing route {route['id']} for {params['point']}, {params['declared_distance'] = }")
+    return [(route['route']['coordinates'], route['real_distance'])]
+
+
+def save_route(loops: list[tuple], params: dict, user_id) -> dict | None:
+    """
+    Save the best loop for logged users and build the route output, None if saving failed.
+    A reused route (params['reused_route']) is never saved again, it keeps its id and timestamp
+    for its owner and is returned like an anonymous route to everybody else.
+    """
+    tolerance = params['simplify_tolerance_m']
+    with observe_stage('simplify'):
+        (coords, real_distance), *alternative_loops = [
+            (simplify_route(loop_coords, tolerance), loop_distance) for loop_coords, loop_distance in loops
+        ]
+    declared_parameters = {
+        key: value for key, value in params.items() if key not in ('alternatives', 'seed', 'simplify_tolerance_m', 'weather', 'reuse', 'reused_route')
+    }
+    reused_route = params.get('reused_route')
+
+    if reused_route is not None:
+        is_owner = user_id is not None and str(reused_route['user_id']) == str(user_id)
+        route_id = reused_route['id'] if is_owner else -1
+        timestamp = reused_route['timestamp'] if is_owner else datetime.now()
+
+    elif user_id:
+        queries = db()
+
+        route_data = {
+            "route": coords,
+            "latitude": params['point']['latitude'],
+            "longitude": params['point']['longitude'],
             "real_distance": real_distance,
-            "declared_parameters": {
-                "point": {
-                    "latitude": latitude,
-                    "longitude": longitude
-                },
-                "declared_distance": declared_distance,
-                "is_prefer_green": is_prefer_green,
-                "is_avoid_green": is_avoid_green,
-                "is_include_weather": is_include_weather,
-            },
-            "timestamp": timestamp
+            "declared_distance": params['declared_distance'],
+            "is_prefer_green": params['is_prefer_green'],
+            "is_avoid_green": params['is_avoid_green'],
+            "is_include_weather": params['is_include_weather'],
+            "user_id": user_id
         }
-        return output_json, 200
+
+        with observe_stage('insert_route'):
+            result = queries.insert_route(route_data)
+
+        if not result:
+            return None
+            
+        route_id = result['id']
+        timestamp = result['timestamp']
+    
+    else:
+        route_id = -1
+        timestamp = datetime.now()
+    
+    return {
+        "id": route_id,
+        "route": {
+            'type': 'LineString',
+            'coordinates': coords,
+        },   
+        "real_distance": real_distance,
+        "declared_parameters": declared_parameters,
+        "timestamp": timestamp,
+        "weather": params['weather'],
+        "alternatives": [
+            {
+                "route": {
+                    'type': 'LineString',
+                    'coordinates': alternative_coords,
+                },
+                "real_distance": alternative_distance,
+            }
+            for alternative_coords, alternative_distance in alternative_loops
+        ]
+    }
+
+
+def complete_route_job(job_id: str, params: dict, user_id, future: Future, cache_key: tuple | None) -> None:
+    """
+    Store the result of a finished route job and push it to the user through the notifier.
+    Reused routes come without cache_key and are not cached.
+    """
+    try:
+        loops = future.result()
+        if loops and cache_key is not None:
+            route_cache.put(cache_key, loops)
+        output_json = save_route(loops, params, user_id) if loops else None
+        if not output_json:
+            raise RuntimeError('Route could not be generated')
+    except Exception as e:
+        log.error(f'Route job {job_id} failed: {e}')
+        route_jobs.fail(job_id, str(e) or 'Route generation failed')
+    else:
+        route_jobs.finish(job_id, marshal(output_json, generated_route_model))
+
+    if not user_id:
+        return
+
+    try:
+        send_request('POST', Services.NOTIFIER, '/emit/route_ready', json_data={
+            'user_owner_id': str(user_id),
+            'notification_id': job_id,
+            'data': marshal(route_jobs.get(job_id), route_job_model),
+            'timestamp': str(datetime.now()),
+        })
+    except Exception as e:
+        log.error(f'Cannot notify user {user_id} about route job {job_id}: {e}')
 
 
 loodspot_model = api.model('Loodspot', {
@@ -1,18 +1,34 @@
 import os
+import gc
+import time
 import random
 import logging
 import threading
 
 import numpy as np
-import networkx as nx
 import osmnx as ox
+import shapely
 
+from .graph import RoutingGraph, NoPathError, astar, shortest_path_tree, tree_path, ring_nodes
+from .metrics import record_stage
+from .tiles import graph_registry
 
-G = None
+
+R: RoutingGraph | None = None
 GRAPH_FILEPATH = "/app/graph/cracow_graph.graphml"
+SNAPSHOT_FILEPATH = "/app/graph/cracow_graph.snapshot"
+GREEN_AREAS_FILEPATH = "/app/graph/cracow_green.geojson"
+CITY = "Kraków, Polska"
+REGION_NAME = "cracow"
+TILE_MARGIN_M = 500
 _event_graph_loaded = threading.Event()
 log = logging.getLogger('ROUTE_ALGORITHM')
 
+GREEN_DISTANCE_THRESHOLDS = (0.001, 0.005, 0.01)
+GREEN_MULTIPLIERS = (0.3, 0.6, 0.8, 1.2)
+AVOID_GREEN_MULTIPLIERS = (3.0, 2.0, 1.5, 0.8)
+POLYGONAL_TYPE_IDS = np.array([shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON])
+
 
 def calculate_new_coords(start_lat, start_lon, distance_km, bearing_deg):
     start_lat_rad = np.radians(start_lat)
@@ -28,99 +44,129 @@ def calculate_new_coords(start_lat, start_lon, distance_km, bearing_deg):
     return new_lat, new_lon
 
 
-def add_green_weights_to_graph(graph):
-    """Add green area weights to graph edges for preference/avoidance routing."""
+def distance_to_green(lons: np.ndarray, lats: np.ndarray, green_geometries) -> np.ndarray:
+    """Distance (in degrees) from every point to the nearest green polygon, inf beyond the widest threshold."""
+    geometries = np.asarray(green_geometries, dtype=object)
+    polygons = geometries[np.isin(shapely.get_type_id(geometries), POLYGONAL_TYPE_IDS)]
+
+    distances = np.full(len(lons), np.inf)
+    if not len(polygons):
+        return distances
+
+    tree = shapely.STRtree(polygons)
+    (point_idx, _), point_distances = tree.query_nearest(
+        shapely.points(lons, lats),
+        max_distance=GREEN_DISTANCE_THRESHOLDS[-1],
+        return_distance=True,
+    )
+    np.minimum.at(distances, point_idx, point_distances)
+    return distances
+
+
+def compute_green_weights(lengths: np.ndarray, distances: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Green preference and avoidance weights for edges of given lengths and distances to green areas."""
+    conditions = [distances < threshold for threshold in GREEN_DISTANCE_THRESHOLDS]
+    green_weight = lengths * np.select(conditions, GREEN_MULTIPLIERS[:-1], GREEN_MULTIPLIERS[-1])
+    avoid_green_weight = lengths * np.select(conditions, AVOID_GREEN_MULTIPLIERS[:-1], AVOID_GREEN_MULTIPLIERS[-1])
+    return green_weight, avoid_green_weight
+
+
+def fetch_green_areas(graph):
+    north = max(graph.nodes[node]['y'] for node in graph.nodes())
+    south = min(graph.nodes[node]['y'] for node in graph.nodes())
+    east = max(graph.nodes[node]['x'] for node in graph.nodes())
+    west = min(graph.nodes[node]['x'] for node in graph.nodes())
+    
+    return ox.features_from_bbox(
+        (west, south, east, north),
+        tags={
+            'leisure': ['park', 'garden', 'nature_reserve', 'recreation_ground'],
+            'landuse': ['forest', 'grass', 'meadow', 'recreation_ground'],
+        }
+    )
+
+
+def edge_midpoints(graph, edges) -> tuple[np.ndarray, np.ndarray]:
+    """Longitudes and latitudes of the midpoints between the end nodes of (u, v, ...) edges."""
+    node_x = dict(graph.nodes(data='x'))
+    node_y = dict(graph.nodes(data='y'))
+    edge_lons = np.array([(node_x[u] + node_x[v]) / 2 for u, v, *_ in edges], dtype=np.float64)
+    edge_lats = np.array([(node_y[u] + node_y[v]) / 2 for u, v, *_ in edges], dtype=np.float64)
+    return edge_lons, edge_lats
+
+
+def add_green_weights_to_graph(graph, green_areas=None, edges=None):
+    """
+    Add green area weights to graph edges for preference/avoidance routing, green areas are fetched from OSM if not given.
+    With edges, a list of (u, v, key), only these edges are weighted.
+    """
+    if edges is None:
+        edges = list(graph.edges(keys=True, data='length'))
+    else:
+        edges = [(u, v, key, graph[u][v][key]['length']) for u, v, key in edges]
+
     try:
-        north = max(graph.nodes[node]['y'] for node in graph.nodes())
-        south = min(graph.nodes[node]['y'] for node in graph.nodes())
-        east = max(graph.nodes[node]['x'] for node in graph.nodes())
-        west = min(graph.nodes[node]['x'] for node in graph.nodes())
-        
-        green_areas = ox.features_from_bbox(
-            north, south, east, west,
-            tags={
-                'leisure': ['park', 'garden', 'nature_reserve', 'recreation_ground'],
-                'landuse': ['forest', 'grass', 'meadow', 'recreation_ground'],
-            }
-        )
+        if green_areas is None:
+            green_areas = fetch_green_areas(graph)
         
         log.info(f"Found {len(green_areas)} green areas")
         
-        for u, v, key in graph.edges(keys=True):
-            node_u = graph.nodes[u]
-            node_v = graph.nodes[v]
-            edge_lat = (node_u['y'] + node_v['y']) / 2
-            edge_lon = (node_u['x'] + node_v['x']) / 2
-            
-            min_distance_to_green = float('inf')
-    
-            for idx, green_area in green_areas.iterrows():
-                try:
-                    if green_area.geometry.geom_type == 'Polygon':
-                        from shapely.geometry import Point
-                        edge_point = Point(edge_lon, edge_lat)
-                        distance = edge_point.distance(green_area.geometry)
-                        min_distance_to_green = min(min_distance_to_green, distance)
-                    elif green_area.geometry.geom_type == 'MultiPolygon':
-                        from shapely.geometry import Point
-                        edge_point = Point(edge_lon, edge_lat)
-                        for polygon in green_area.geometry.geoms:
-                            distance = edge_point.distance(polygon)
-                            min_distance_to_green = min(min_distance_to_green, distance)
-                except:
-                    continue
-            
-            base_weight = graph[u][v][key]['length']
-            
-            if min_distance_to_green < 0.001:  
-                green_weight = base_weight * 0.3 
-                avoid_green_weight = base_weight * 3.0 
-            elif min_distance_to_green < 0.005:  
-                green_weight = base_weight * 0.6  
-                avoid_green_weight = base_weight * 2.0  
-            elif min_distance_to_green < 0.01:   
-                green_weight = base_weight * 0.8  
-                avoid_green_weight = base_weight * 1.5  
-            else:
-                green_weight = base_weight * 1.2  
-                avoid_green_weight = base_weight * 0.8  
-            
+        edge_lons, edge_lats = edge_midpoints(graph, edges)
+        lengths = np.array([length for _, _, _, length in edges], dtype=np.float64)
+
+        min_distance_to_green = distance_to_green(edge_lons, edge_lats, green_areas.geometry.values)
+        green_weights, avoid_green_weights = compute_green_weights(lengths, min_distance_to_green)
+
+        for (u, v, key, _), green_weight, avoid_green_weight in zip(
+            edges, green_weights.tolist(), avoid_green_weights.tolist()
+        ):
             graph[u][v][key]['green_weight'] = green_weight
             graph[u][v][key]['avoid_green_weight'] = avoid_green_weight
             
     except Exception as e:
         log.warning(f"Could not load green areas: {e}. Using default weights.")
-        for u, v, key in graph.edges(keys=True):
-            graph[u][v][key]['green_weight'] = graph[u][v][key]['length']
-            graph[u][v][key]['avoid_green_weight'] = graph[u][v][key]['length']
+        for u, v, key, length in edges:
+            graph[u][v][key]['green_weight'] = length
+            graph[u][v][key]['avoid_green_weight'] = length
 
 
-def find_green_route(graph, start_node, end_node, prefer_green=False, avoid_green=False):
-    """Find route with optional green area preference or avoidance."""
+def get_weight_attr(prefer_green=False, avoid_green=False):
     if avoid_green:
-        weight_attr = 'avoid_green_weight'
+        return 'avoid_green_weight'
     elif prefer_green:
-        weight_attr = 'green_weight'
-    else:
-        weight_attr = 'length'
-    
+        return 'green_weight'
+    return 'length'
+
+
+def find_green_route(
+    graph: RoutingGraph,
+    start_node,
+    end_node,
+    prefer_green=False,
+    avoid_green=False,
+    excluded_nodes=frozenset(),
+    excluded_edges=frozenset()
+):
+    """Find route with optional green area preference or avoidance, skipping excluded nodes and edges."""
+    def search(weight_attr):
+        return astar(graph, start_node, end_node, weight_attr, excluded_nodes=excluded_nodes, excluded_edges=excluded_edges)
+
     try:
-        path = nx.shortest_path(graph, start_node, end_node, weight=weight_attr)
-        return path
-    except nx.NetworkXNoPath:
+        return search(get_weight_attr(prefer_green, avoid_green))
+    except NoPathError:
         if prefer_green or avoid_green:
             log.warning(f"{'Green avoidance' if avoid_green else 'Green preference'} route not found, falling back to regular routing")
-            return nx.shortest_path(graph, start_node, end_node, weight='length')
+            return search('length')
         else:
             raise
 
 
-def select_non_adjacent_nodes(path_segment, count):
+def select_non_adjacent_nodes(path_segment, count, rng: random.Random = random):
     selected = []
     available_indices = list(range(len(path_segment)))
 
     while len(selected) < count and available_indices:
-        idx = random.choice(available_indices)
+        idx = rng.choice(available_indices)
         node = path_segment[idx]
 
         if (idx > 0 and path_segment[idx - 1] in selected) or \
@@ -137,129 +183,277 @@ def select_non_adjacent_nodes(path_segment, count):
     return selected
 
 
-def load_graph():
+def check_deadline(deadline: float | None) -> None:
+    """Raise TimeoutError once the time.time() deadline of a route job has passed."""
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutError('Route generation deadline exceeded')
+
+
+def load_graph(graph_filepath=GRAPH_FILEPATH, snapshot_filepath=SNAPSHOT_FILEPATH):
     log.info('Graph loading started')
-    global G, _event_graph_loaded
-    if not os.path.exists(GRAPH_FILEPATH):
-        G = download_and_save_graph()
-    else:
+    global R, _event_graph_loaded
+
+    graph_registry.add_tiles_directory()
+    if REGION_NAME in graph_registry.regions:
+        log.info(f'Graph of {REGION_NAME} served from tiles')
+        _event_graph_loaded.set()
+        return
+
+    routing_graph = None
+    if os.path.exists(snapshot_filepath):
         try:
-            G = ox.load_graphml(GRAPH_FILEPATH)
+            routing_graph = RoutingGraph.load(snapshot_filepath)
         except Exception as e:
-            log.exception(f'Exception during graph loading: {e}')
-            G = download_and_save_graph()
-    
-    
-    log.info('Graph loaded')
+            log.exception(f'Exception during graph snapshot loading: {e}')
+
+    if routing_graph is None:
+        if not os.path.exists(graph_filepath):
+            graph = download_and_save_graph(graph_filepath)
+        else:
+            try:
+                graph = ox.load_graphml(graph_filepath)
+            except Exception as e:
+                log.exception(f'Exception during graph loading: {e}')
+                graph = download_and_save_graph(graph_filepath)
+        
+        routing_graph = save_graph_snapshot(graph, snapshot_filepath)
+        # the osmnx graph holds every OSM attribute in per-edge dicts, routing only needs the snapshot
+        del graph
+        gc.collect()
+
+    routing_graph.build_spatial_index()
+    R = routing_graph
+    graph_registry.register(REGION_NAME, R)
+    log.info(f'Graph loaded: {len(R)} nodes, {R.num_edges} edges, {R.nbytes / 2 ** 20:.1f} MiB')
     _event_graph_loaded.set()
 
 
-def download_and_save_graph():
-    city = "Kraków, Polska"
-    G = ox.graph_from_place(city, network_type="walk", simplify=True)
-    add_green_weights_to_graph(G)
-    ox.save_graphml(G, filepath=GRAPH_FILEPATH)
+def download_graph():
+    return ox.graph_from_place(CITY, network_type="walk", simplify=True)
+
+
+def download_and_save_graph(filepath=GRAPH_FILEPATH, green_areas_filepath=GREEN_AREAS_FILEPATH):
+    G = download_graph()
+    green_areas = None
+    try:
+        green_areas = fetch_green_areas(G)
+        save_green_areas(green_areas, green_areas_filepath)
+    except Exception as e:
+        log.warning(f"Could not save green areas: {e}")
+    add_green_weights_to_graph(G, green_areas)
+    ox.save_graphml(G, filepath=filepath)
     return G
 
 
+def save_green_areas(green_areas, filepath=GREEN_AREAS_FILEPATH):
+    """Store green area geometries with their OSM ids, so a refresh can tell which of them changed."""
+    green_areas[['geometry']].reset_index().to_file(filepath, driver='GeoJSON')
+
+
+def save_graph_snapshot(graph, filepath=SNAPSHOT_FILEPATH) -> RoutingGraph:
+    routing_graph = RoutingGraph.from_networkx(graph, include_geometry=True)
+    try:
+        routing_graph.save(filepath)
+    except Exception as e:
+        log.exception(f'Exception during graph snapshot saving: {e}')
+    return routing_graph
+
+
+def find_return_path(
+    graph: RoutingGraph,
+    path,
+    start_node,
+    end_node,
+    is_prefer_green,
+    is_avoid_green,
+    rng: random.Random = random,
+    stats: dict | None = None,
+    deadline: float | None = None
+):
+    """
+    Find a return path avoiding randomly blocked nodes of the outbound path, None if there is none.
+    Failed attempts are counted in stats['return_path_retries'] if given.
+    Raises TimeoutError when the deadline passes between attempts.
+    """
+    path_length = len(path)
+    quarter = path_length // 4
+    q1 = path[1:quarter]
+    q2 = path[quarter:2 * quarter]
+    q3 = path[2 * quarter:3 * quarter]
+    q4 = path[3 * quarter:-1]
+
+    quarters = [q1, q2, q3, q4]
+
+    for retry in range(3):
+        check_deadline(deadline)
+        blocked_nodes = set()
+        for quarter_path in quarters:
+            if len(quarter_path) < 3:
+                continue
+            count = rng.randint(2, 3)
+            selected = select_non_adjacent_nodes(quarter_path, count, rng)
+            blocked_nodes.update(selected)
+
+        try:
+            return find_green_route(
+                graph, end_node, start_node, is_prefer_green, is_avoid_green, excluded_nodes=blocked_nodes
+            )
+        except NoPathError:
+            log.info('no path exception, retry')
+            if stats is not None:
+                stats['return_path_retries'] = stats.get('return_path_retries', 0) + 1
+            if retry == 0:
+                quarters = [*quarters[:2], quarters[2] + quarters[3]]
+            elif retry == 1:
+                quarters = [quarters[0] + quarters[1], quarters[2]]
+            elif retry == 2:
+                quarters = [quarters[0] + quarters[1]]
+    
+    return None
+
+
+def path_overlap(path, return_path) -> float:
+    """Fraction of return path edges that are also used (in any direction) by the outbound path."""
+    if len(return_path) < 2:
+        return 0.0
+    outbound_edges = {frozenset(edge) for edge in zip(path, path[1:])}
+    shared = sum(frozenset(edge) in outbound_edges for edge in zip(return_path, return_path[1:]))
+    return shared / (len(return_path) - 1)
+
+
+def snap_point(point: tuple[float], stats: dict | None = None) -> tuple[int, tuple[float]]:
+    """OSM id of the nearest graph node of a (latitude, longitude) point and the node's own (latitude, longitude)."""
+    _event_graph_loaded.wait()
+    graph = graph_registry.graph_for(point, stats=stats)
+    node = int(graph.snap([point])[0])
+    return int(graph.node_ids[node]), (float(graph.y[node]), float(graph.x[node]))
+
+
 def algorithm(
     starting_point: tuple[float],
     declared_distance: int,
     is_prefer_green: bool = False,
     is_avoid_green: bool = False,
-    is_include_wheather: bool = False
-) -> tuple[int] | tuple[None, 2]:
-    global G, _event_graph_loaded
+    is_include_wheather: bool = False,
+    is_single_search: bool = True,
+    alternatives: int | None = None,
+    seed: int | None = None,
+    stats: dict | None = None,
+    deadline: float | None = None
+) -> tuple[int] | tuple[None, 2] | list[tuple]:
+    """
+    Generate a loop of roughly declared_distance meters from starting_point.
+
+    With is_single_search one distance-bounded search from the start node gives the outbound
+    legs to every turnaround candidate on the declared_distance / 2 ring, otherwise a separate
+    search is run towards a random bearing on every retry.
+
+    With alternatives=N a list of up to N distinct (route_coords, real_distance) loops is returned
+    instead, ranked by distance error and by how much the return leg overlaps the outbound one.
+
+    All random choices come from a generator seeded with seed, so the same inputs and seed
+    always give the same routes.
+
+    If stats dict is given, general_retries, return_path_retries and reverse_path_fallbacks
+    counters and the seconds spent in every stage (stage_seconds) are written to it.
+
+    With a time.time() deadline, TimeoutError is raised once it passes, checked before every
+    search for a turnaround candidate and a return path.
+    """
+    global _event_graph_loaded
 
     _event_graph_loaded.wait()
+    check_deadline(deadline)
     
     start_lat, start_lon = starting_point
     distance_km = declared_distance / 1000.0
 
+    rng = random.Random(seed)
+    stats = stats if stats is not None else {}
+    stats.update(general_retries=0, return_path_retries=0, reverse_path_fallbacks=0, stage_seconds={})
     num_of_retries = 3
+    num_of_candidates = num_of_retries * (alternatives or 1)
+
+    weight_attr = get_weight_attr(is_prefer_green, is_avoid_green)
+    graph = graph_registry.graph_for(starting_point, declared_distance / 2 + TILE_MARGIN_M, stats)
+
+    if is_single_search:
+        with record_stage(stats, 'snap'):
+            start_node = int(graph.snap([starting_point])[0])
+        with record_stage(stats, 'outbound_search'):
+            lengths, predecessors = shortest_path_tree(graph, start_node, weight_attr, max_length=declared_distance / 2)
+            candidates = ring_nodes(lengths, predecessors, declared_distance / 2)
+        if not candidates:
+            candidates = [max(lengths, key=lengths.get)]
+        end_nodes = rng.sample(candidates, min(num_of_candidates, len(candidates)))
+    else:
+        bearings = [rng.uniform(0, 360) for _ in range(num_of_candidates)]
+        end_points = [calculate_new_coords(start_lat, start_lon, distance_km / 2, bearing) for bearing in bearings]
+        with record_stage(stats, 'snap'):
+            start_node, *end_nodes = graph.snap([starting_point, *end_points]).tolist()
 
-    for general_retry in range(num_of_retries):
-        try:
-            random_bearing = random.uniform(0, 360)
-            new_lat, new_lon = calculate_new_coords(start_lat, start_lon, distance_km / 2, random_bearing)
-
-            start_node = ox.distance.nearest_nodes(G, start_lon, start_lat)
-            end_node = ox.distance.nearest_nodes(G, new_lon, new_lat)
+    loops = []
 
-            path = find_green_route(G, start_node, end_node, is_prefer_green, is_avoid_green)
-            
-            if is_avoid_green:
-                weight_attr = 'avoid_green_weight'
-            elif is_prefer_green:
-                weight_attr = 'green_weight'
+    for general_retry, end_node in enumerate(end_nodes):
+        check_deadline(deadline)
+        try:
+            if is_single_search:
+                path = tree_path(predecessors, end_node)
             else:
-                weight_attr = 'length'
-            
-            half_real_dinstance = 0
-            for i in range(len(path) - 1):
-                edge_weight = G[path[i]][path[i+1]][0].get(weight_attr, G[path[i]][path[i+1]][0]['length'])
-                half_real_dinstance += edge_weight
-                if half_real_dinstance >= declared_distance / 2:
-                    path = path[:i]
-                    end_node = path[i-1]
-                    break
+                with record_stage(stats, 'outbound_search'):
+                    path = find_green_route(graph, start_node, end_node, is_prefer_green, is_avoid_green)
                     
-            path_length = len(path)
-            quarter = path_length // 4
-            q1 = path[1:quarter]
-            q2 = path[quarter:2 * quarter]
-            q3 = path[2 * quarter:3 * quarter]
-            q4 = path[3 * quarter:-1]
-
-            quarters = [q1, q2, q3, q4]
-
-            for retry in range(3):
-                blocked_nodes = []
-                for quarter_path in quarters:
-                    if len(quarter_path) < 3:
-                        continue
-                    count = random.randint(2, 3)
-                    selected = select_non_adjacent_nodes(quarter_path, count)
-                    blocked_nodes.extend(selected)
-
-                G_modified = G.copy()
-                G_modified.remove_nodes_from(blocked_nodes)
-
-                try:
-                    return_path = find_green_route(G_modified, end_node, start_node, is_prefer_green, is_avoid_green)
-                except nx.NetworkXNoPath:
-                    log.info('no path exception, retry')
-                    if retry == 0:
-                        quarters = [*quarters[:2], quarters[2] + quarters[3]]
-                    elif retry == 1:
-                        quarters = [quarters[0] + quarters[1], quarters[2]]
-                    elif retry == 2:
-                        quarters = [quarters[0] + quarters[1]]
-                    continue
-                break
-            else:
+                    weights = graph.weights[weight_attr]
+                    
+                    half_real_dinstance = 0
+                    for i in range(len(path) - 1):
+                        half_real_dinstance += weights[graph.edge_index(path[i], path[i+1], weight_attr)]
+                        if half_real_dinstance >= declared_distance / 2:
+                            path = path[:i]
+                            end_node = path[i-1]
+                            break
+
+            with record_stage(stats, 'return_search'):
+                return_path = find_return_path(
+                    graph, path, start_node, end_node, is_prefer_green, is_avoid_green, rng, stats, deadline
+                )
+
+            if return_path is None:
                 log.info('Cannot find another return path')
-                if general_retry == num_of_retries - 1:
+                if general_retry == len(end_nodes) - 1 and not loops:
                     log.info('Set return path equal to initial')
                     return_path = path[::-1]
+                    stats['reverse_path_fallbacks'] += 1
                 else:
-                    log.info('Retry for different end point angle')
+                    log.info('Retry for different end point')
+                    stats['general_retries'] += 1
                     continue
 
-            route_coords = [(G.nodes[node]['x'], G.nodes[node]['y']) for node in path + return_path]
-            
-            real_distance = 0
-            for i in range(len(path) - 1):
-                real_distance += G[path[i]][path[i+1]][0]['length']
-            
-            for i in range(len(return_path) - 1):
-                if G.has_edge(return_path[i], return_path[i+1]):
-                    real_distance += G[return_path[i]][return_path[i+1]][0]['length']
-            
-            return route_coords, int(real_distance)
+            with record_stage(stats, 'assemble'):
+                route_coords = graph.coords(path + return_path)
+                
+                real_distance = graph.path_length(path) + graph.path_length(return_path, strict=False)
+
+            if alternatives is None:
+                return route_coords, int(real_distance)
+
+            if any(route_coords == loop_coords for loop_coords, *_ in loops):
+                continue
+
+            score = abs(real_distance - declared_distance) / declared_distance + path_overlap(path, return_path)
+            loops.append((route_coords, int(real_distance), score))
+            if len(loops) >= 2 * alternatives:
+                break
 
+        except TimeoutError:
+            raise
         except Exception as e:
             log.exception(f"Error in algorithm: {e}")
+            stats['general_retries'] += 1
             continue
-    else:
-        return None, None
\ No newline at end of file
+
+    if alternatives is None:
+        return None, None
+
+    loops.sort(key=lambda loop: loop[2])
+    return [(route_coords, real_distance) for route_coords, real_distance, _ in loops[:alternatives]]
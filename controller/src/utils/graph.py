@@ -0,0 +1,539 @@
+import os
+import json
+import math
+import shutil
+import logging
+import tempfile
+from heapq import heappush, heappop
+
+import numpy as np
+import networkx as nx
+from scipy.spatial import cKDTree
+
+
+log = logging.getLogger('ROUTING_GRAPH')
+
+WEIGHT_PROFILES = ('length', 'green_weight', 'avoid_green_weight')
+EARTH_RADIUS_M = 6371000.0
+SNAPSHOT_VERSION = 2
+INDEX_DTYPE = np.int32
+WEIGHT_DTYPE = np.float32
+GEOMETRY_DTYPE = np.float32
+
+
+class NoPathError(Exception):
+    pass
+
+
+class RoutingGraph:
+    """
+    Compact CSR form of the walk graph used by the routing algorithm.
+
+    Only the fields routing reads are kept, in typed arrays: float64 node coordinates, int32 CSR
+    indices and float32 weights and edge geometry. Nodes are addressed by their index (0..n-1),
+    `node_ids` maps them back to OSM ids and `index_of` maps OSM ids to indices.
+    Outgoing edges of node `u` are `indices[indptr[u]:indptr[u + 1]]`, with one weight
+    array per profile aligned with `indices`. Optional edge geometry is kept as flat
+    (lon, lat) `geometry_coords` sliced by `geometry_offsets`, empty for straight edges.
+    """
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        x: np.ndarray,
+        y: np.ndarray,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        weights: dict[str, np.ndarray],
+        geometry_offsets: np.ndarray | None = None,
+        geometry_coords: np.ndarray | None = None
+    ):
+        self.node_ids = node_ids
+        self.x = x
+        self.y = y
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.geometry_offsets = geometry_offsets
+        self.geometry_coords = geometry_coords
+        self._id_order = None
+        self._kdtree = None
+        self._min_weight_ratios = {}
+        self._reference_lat = None
+
+    @classmethod
+    def from_networkx(cls, graph: nx.MultiDiGraph, include_geometry: bool = False) -> 'RoutingGraph':
+        node_ids = np.fromiter(graph.nodes(), dtype=np.int64, count=graph.number_of_nodes())
+        index_by_id = {node_id: i for i, node_id in enumerate(node_ids.tolist())}
+
+        x = np.fromiter((data['x'] for _, data in graph.nodes(data=True)), dtype=np.float64, count=len(node_ids))
+        y = np.fromiter((data['y'] for _, data in graph.nodes(data=True)), dtype=np.float64, count=len(node_ids))
+
+        num_edges = graph.number_of_edges()
+        sources = np.empty(num_edges, dtype=INDEX_DTYPE)
+        targets = np.empty(num_edges, dtype=INDEX_DTYPE)
+        weights = {profile: np.empty(num_edges, dtype=WEIGHT_DTYPE) for profile in WEIGHT_PROFILES}
+        geometries = []
+
+        for i, (u, v, data) in enumerate(graph.edges(data=True)):
+            sources[i] = index_by_id[u]
+            targets[i] = index_by_id[v]
+            length = float(data['length'])
+            for profile in WEIGHT_PROFILES:
+                weights[profile][i] = float(data.get(profile, length))
+            if include_geometry:
+                geometry = data.get('geometry')
+                geometries.append(np.asarray(geometry.coords) if geometry is not None else np.empty((0, 2)))
+
+        geometry_offsets = geometry_coords = None
+        if include_geometry:
+            geometry_offsets = np.zeros(num_edges + 1, dtype=INDEX_DTYPE)
+            np.cumsum([len(coords) for coords in geometries], out=geometry_offsets[1:])
+            geometry_coords = np.concatenate(geometries) if geometries else np.empty((0, 2))
+
+        return cls.from_edges(node_ids, x, y, sources, targets, weights, geometry_offsets, geometry_coords)
+
+    @classmethod
+    def from_edges(
+        cls,
+        node_ids: np.ndarray,
+        x: np.ndarray,
+        y: np.ndarray,
+        sources: np.ndarray,
+        targets: np.ndarray,
+        weights: dict[str, np.ndarray],
+        geometry_offsets: np.ndarray | None = None,
+        geometry_coords: np.ndarray | None = None
+    ) -> 'RoutingGraph':
+        """
+        Build the CSR arrays from unordered edges given as source and target node indices.
+        """
+        order = np.argsort(sources, kind='stable')
+        indptr = np.zeros(len(node_ids) + 1, dtype=INDEX_DTYPE)
+        np.cumsum(np.bincount(sources, minlength=len(node_ids)), out=indptr[1:])
+
+        if geometry_offsets is not None:
+            geometry_offsets, geometry_coords = _take_geometry(geometry_offsets, geometry_coords, order)
+
+        return cls(
+            node_ids=np.asarray(node_ids, dtype=np.int64),
+            x=np.asarray(x, dtype=np.float64),
+            y=np.asarray(y, dtype=np.float64),
+            indptr=indptr,
+            indices=np.asarray(targets[order], dtype=INDEX_DTYPE),
+            weights={profile: np.asarray(array[order], dtype=WEIGHT_DTYPE) for profile, array in weights.items()},
+            geometry_offsets=geometry_offsets,
+            geometry_coords=geometry_coords
+        )
+
+    @classmethod
+    def merge(cls, graphs: list['RoutingGraph']) -> 'RoutingGraph':
+        """
+        Union of graphs sharing OSM node ids, e.g. neighbouring tiles. Nodes present in several graphs
+        are merged into one, their edges are the edges of all copies. Hierarchies are not kept.
+        """
+        node_ids, first, inverse = np.unique(
+            np.concatenate([graph.node_ids for graph in graphs]), return_index=True, return_inverse=True
+        )
+        x = np.concatenate([graph.x for graph in graphs])[first]
+        y = np.concatenate([graph.y for graph in graphs])[first]
+
+        sources, targets, node_offset = [], [], 0
+        for graph in graphs:
+            local = inverse[node_offset:node_offset + len(graph)]
+            sources.append(local[np.repeat(np.arange(len(graph)), np.diff(graph.indptr))])
+            targets.append(local[graph.indices])
+            node_offset += len(graph)
+
+        profiles = [profile for profile in graphs[0].weights if all(profile in graph.weights for graph in graphs)]
+        weights = {profile: np.concatenate([graph.weights[profile] for graph in graphs]) for profile in profiles}
+
+        geometry_offsets = geometry_coords = None
+        if all(graph.geometry_offsets is not None for graph in graphs):
+            coords_offsets = np.cumsum([0] + [len(graph.geometry_coords) for graph in graphs[:-1]])
+            geometry_offsets = np.concatenate(
+                [graph.geometry_offsets[:-1] + offset for graph, offset in zip(graphs, coords_offsets)]
+                + [[sum(len(graph.geometry_coords) for graph in graphs)]]
+            )
+            geometry_coords = np.concatenate([graph.geometry_coords for graph in graphs])
+
+        return cls.from_edges(
+            node_ids, x, y, np.concatenate(sources), np.concatenate(targets), weights, geometry_offsets, geometry_coords
+        )
+
+    def subgraph(self, nodes: np.ndarray) -> 'RoutingGraph':
+        """
+        Graph of the given nodes with all their outgoing edges. Targets of these edges outside nodes
+        are kept as nodes without outgoing edges, so the subgraph can be merged back with its neighbours.
+        """
+        nodes = np.sort(np.asarray(nodes, dtype=np.int64))
+        degrees = np.diff(self.indptr)[nodes]
+        edges = np.repeat(self.indptr[nodes] - np.cumsum(np.concatenate(([0], degrees[:-1]))), degrees) + \
+            np.arange(degrees.sum())
+
+        targets = self.indices[edges]
+        boundary = np.setdiff1d(targets, nodes)
+        kept = np.concatenate((nodes, boundary))
+        local = np.full(len(self), -1, dtype=np.int32)
+        local[kept] = np.arange(len(kept), dtype=np.int32)
+
+        geometry_offsets = geometry_coords = None
+        if self.geometry_offsets is not None:
+            geometry_offsets, geometry_coords = _take_geometry(self.geometry_offsets, self.geometry_coords, edges)
+
+        return RoutingGraph.from_edges(
+            self.node_ids[kept],
+            self.x[kept],
+            self.y[kept],
+            np.repeat(np.arange(len(nodes), dtype=np.int32), degrees),
+            local[targets],
+            {profile: array[edges] for profile, array in self.weights.items()},
+            geometry_offsets,
+            geometry_coords
+        )
+
+    def _arrays(self) -> dict[str, np.ndarray]:
+        arrays = {
+            'node_ids': self.node_ids,
+            'x': self.x,
+            'y': self.y,
+            'indptr': self.indptr,
+            'indices': self.indices,
+            **{f'weight_{profile}': array for profile, array in self.weights.items()},
+        }
+        if self.geometry_offsets is not None:
+            arrays['geometry_offsets'] = self.geometry_offsets
+            arrays['geometry_coords'] = self.geometry_coords
+        return arrays
+
+    def save(self, path: str) -> None:
+        """
+        Write the graph as a snapshot directory of .npy arrays, replacing an existing one atomically.
+        Every writer uses its own temporary directory, so concurrent writers of the same snapshot
+        (route workers, the reloader) never touch each other's files, the first one in place wins.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        tmp_path = tempfile.mkdtemp(prefix=f'{name}.', suffix='.tmp', dir=directory)
+        os.chmod(tmp_path, 0o755)
+
+        try:
+            arrays = self._arrays()
+            for array_name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f'{array_name}.npy'), np.ascontiguousarray(array))
+
+            with open(os.path.join(tmp_path, 'meta.json'), 'w') as file:
+                json.dump({
+                    'version': SNAPSHOT_VERSION,
+                    'profiles': list(self.weights),
+                    'arrays': list(arrays),
+                    'nodes': len(self),
+                    'edges': self.num_edges,
+                }, file)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+        old_path = f'{tmp_path}.old'
+        try:
+            os.replace(path, old_path)
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(tmp_path, path)
+        except OSError:
+            # another writer's snapshot was put in place between the two renames
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> 'RoutingGraph':
+        """
+        Open a snapshot written by `save`, arrays are memory-mapped read-only so processes share the pages.
+        """
+        with open(os.path.join(path, 'meta.json')) as file:
+            meta = json.load(file)
+        if meta['version'] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported graph snapshot version {meta['version']}")
+
+        # plain ndarray views of the memory maps, np.memmap slicing is several times slower
+        arrays = {
+            name: np.asarray(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None))
+            for name in meta['arrays']
+        }
+        return cls(
+            node_ids=arrays['node_ids'],
+            x=arrays['x'],
+            y=arrays['y'],
+            indptr=arrays['indptr'],
+            indices=arrays['indices'],
+            weights={profile: arrays[f'weight_{profile}'] for profile in meta['profiles']},
+            geometry_offsets=arrays.get('geometry_offsets'),
+            geometry_coords=arrays.get('geometry_coords')
+        )
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def memory_usage(self) -> dict[str, int]:
+        """
+        Bytes held by every array of the graph and by its spatial index once built.
+        """
+        usage = {name: array.nbytes for name, array in self._arrays().items()}
+        if self._kdtree is not None:
+            usage['spatial_index'] = self._kdtree.data.nbytes + self._kdtree.indices.nbytes
+        if self._id_order is not None:
+            usage['id_order'] = self._id_order.nbytes
+        return usage
+
+    @property
+    def nbytes(self) -> int:
+        return sum(self.memory_usage().values())
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.indices)
+
+    def index_of(self, node_id: int) -> int:
+        """
+        Index of the node with the given OSM id, raises KeyError if the graph has no such node.
+        """
+        if self._id_order is None:
+            self._id_order = np.argsort(self.node_ids).astype(INDEX_DTYPE)
+        position = int(np.searchsorted(self.node_ids, node_id, sorter=self._id_order))
+        if position == len(self) or self.node_ids[self._id_order[position]] != node_id:
+            raise KeyError(node_id)
+        return int(self._id_order[position])
+
+    def _project(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Equirectangular projection to meters around the graph's reference latitude.
+        """
+        scale = np.cos(np.radians(self._reference_lat))
+        return np.column_stack((
+            np.radians(lons) * scale * EARTH_RADIUS_M,
+            np.radians(lats) * EARTH_RADIUS_M
+        ))
+
+    def build_spatial_index(self) -> None:
+        self._reference_lat = float(self.y.mean())
+        self._kdtree = cKDTree(self._project(self.x, self.y))
+
+    def snap(self, points) -> np.ndarray:
+        """
+        Indices of the nearest nodes for a sequence of (latitude, longitude) points.
+        """
+        if self._kdtree is None:
+            self.build_spatial_index()
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        _, nodes = self._kdtree.query(self._project(points[:, 1], points[:, 0]))
+        return nodes
+
+    def min_weight_ratio(self, weight: str) -> float:
+        """
+        Smallest weight / length multiplier over all edges, scales the A* heuristic of the profile.
+        """
+        if weight not in self._min_weight_ratios:
+            lengths = self.weights['length']
+            positive = lengths > 0
+            ratios = self.weights[weight][positive] / lengths[positive]
+            self._min_weight_ratios[weight] = float(min(ratios.min(), 1.0)) if len(ratios) else 1.0
+        return self._min_weight_ratios[weight]
+
+    def distances_to(self, node: int) -> np.ndarray:
+        """
+        Haversine distance in meters from every node to the given one.
+        """
+        lons, lats = np.radians(self.x), np.radians(self.y)
+        target_lon, target_lat = lons[node], lats[node]
+        a = np.sin((lats - target_lat) / 2) ** 2 + \
+            np.cos(lats) * np.cos(target_lat) * np.sin((lons - target_lon) / 2) ** 2
+        return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+    def coords(self, path: list[int]) -> list[tuple[float, float]]:
+        return list(zip(self.x[path].tolist(), self.y[path].tolist()))
+
+    def edge_index(self, u: int, v: int, weight: str = 'length') -> int | None:
+        """
+        Index of the cheapest edge u -> v for the given profile, None if there is no such edge.
+        """
+        start, end = self.indptr[u], self.indptr[u + 1]
+        candidates = np.flatnonzero(self.indices[start:end] == v)
+        if not len(candidates):
+            return None
+        return int(start + candidates[np.argmin(self.weights[weight][start + candidates])])
+
+    def has_edge(self, u: int, v: int) -> bool:
+        return self.edge_index(u, v) is not None
+
+    def path_length(self, path: list[int], weight: str = 'length', strict: bool = True) -> float:
+        """
+        Sum of edge weights along the path, non-existent edges are skipped unless strict.
+        """
+        total = 0.0
+        for u, v in zip(path, path[1:]):
+            edge = self.edge_index(u, v, weight)
+            if edge is None:
+                if strict:
+                    raise NoPathError(f'No edge between {u} and {v}')
+                continue
+            total += float(self.weights[weight][edge])
+        return total
+
+
+def _take_geometry(offsets: np.ndarray, coords: np.ndarray, edges: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Flat geometry of the given edges, in their order, as new (offsets, coords).
+    """
+    starts = offsets[:-1][edges]
+    counts = offsets[1:][edges] - starts
+    new_offsets = np.zeros(len(edges) + 1, dtype=INDEX_DTYPE)
+    np.cumsum(counts, out=new_offsets[1:])
+    positions = np.repeat(starts - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+    return new_offsets, np.asarray(coords, dtype=GEOMETRY_DTYPE)[positions].reshape(-1, 2)
+
+
+def shortest_path(
+    graph: RoutingGraph,
+    source: int,
+    target: int,
+    weight: str = 'length',
+    excluded_nodes: set[int] = frozenset(),
+    excluded_edges: set[tuple[int, int]] = frozenset(),
+    heuristic: bool = True,
+    stats: dict | None = None
+) -> list[int]:
+    """
+    Shortest path from source to target over the CSR arrays, returns list of node indices.
+    Excluded nodes and (u, v) edges are skipped during the search, the graph itself is never modified.
+
+    With heuristic the search is A* guided by the haversine distance to target scaled by the
+    profile's smallest weight multiplier, which keeps it admissible. Number of settled nodes
+    is written to stats if given.
+    """
+    indptr = graph.indptr
+    indices = graph.indices
+    weights = graph.weights[weight]
+    x = graph.x
+    y = graph.y
+    if heuristic:
+        scale = 2 * EARTH_RADIUS_M * graph.min_weight_ratio(weight)
+        target_lon, target_lat = math.radians(x[target]), math.radians(y[target])
+        cos_target_lat = math.cos(target_lat)
+
+    distances = {source: 0.0}
+    predecessors = {source: -1}
+    settled = set()
+    heap = [(0.0, source)]
+
+    try:
+        while heap:
+            _, u = heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+
+            if u == target:
+                return tree_path(predecessors, target)
+
+            distance = distances[u]
+            start, end = indptr[u], indptr[u + 1]
+            for v, w in zip(indices[start:end].tolist(), weights[start:end].tolist()):
+                if v in settled or v in excluded_nodes:
+                    continue
+                if excluded_edges and (u, v) in excluded_edges:
+                    continue
+                new_distance = distance + w
+                if new_distance < distances.get(v, math.inf):
+                    distances[v] = new_distance
+                    predecessors[v] = u
+                    estimate = 0.0
+                    if heuristic:
+                        lon, lat = math.radians(x[v]), math.radians(y[v])
+                        a = math.sin((lat - target_lat) / 2) ** 2 + \
+                            math.cos(lat) * cos_target_lat * math.sin((lon - target_lon) / 2) ** 2
+                        estimate = scale * math.asin(math.sqrt(a))
+                    heappush(heap, (new_distance + estimate, v))
+    finally:
+        if stats is not None:
+            stats['settled'] = len(settled)
+
+    raise NoPathError(f'No path between {source} and {target}')
+
+
+def dijkstra(graph: RoutingGraph, source: int, target: int, weight: str = 'length', **kwargs) -> list[int]:
+    return shortest_path(graph, source, target, weight, heuristic=False, **kwargs)
+
+
+def astar(graph: RoutingGraph, source: int, target: int, weight: str = 'length', **kwargs) -> list[int]:
+    return shortest_path(graph, source, target, weight, heuristic=True, **kwargs)
+
+
+def shortest_path_tree(
+    graph: RoutingGraph,
+    source: int,
+    weight: str = 'length',
+    max_length: float = np.inf
+) -> tuple[dict[int, float], dict[int, int]]:
+    """
+    Shortest path tree from source ordered by the given profile weight. Nodes whose real length
+    along the tree reaches max_length are reached but not expanded. Returns lengths and predecessors.
+    """
+    indptr = graph.indptr
+    indices = graph.indices
+    weights = graph.weights[weight]
+    edge_lengths = graph.weights['length']
+
+    costs = {source: 0.0}
+    lengths = {source: 0.0}
+    predecessors = {source: -1}
+    settled = set()
+    heap = [(0.0, source)]
+
+    while heap:
+        cost, u = heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+
+        length = lengths[u]
+        if length >= max_length:
+            continue
+
+        start, end = indptr[u], indptr[u + 1]
+        for v, w, edge_length in zip(
+            indices[start:end].tolist(), weights[start:end].tolist(), edge_lengths[start:end].tolist()
+        ):
+            if v in settled:
+                continue
+            new_cost = cost + w
+            if new_cost < costs.get(v, np.inf):
+                costs[v] = new_cost
+                lengths[v] = length + edge_length
+                predecessors[v] = u
+                heappush(heap, (new_cost, v))
+
+    return lengths, predecessors
+
+
+def tree_path(predecessors: dict[int, int], node: int) -> list[int]:
+    path = [node]
+    while predecessors[path[-1]] != -1:
+        path.append(predecessors[path[-1]])
+    return path[::-1]
+
+
+def ring_nodes(lengths: dict[int, float], predecessors: dict[int, int], radius: float) -> list[int]:
+    """
+    Nodes of the shortest path tree where its branches cross the given radius. For every crossing
+    edge the endpoint closer to the radius is taken, so paths to them match the radius most closely.
+    """
+    nodes = set()
+    for node, length in lengths.items():
+        predecessor = predecessors[node]
+        if length < radius or predecessor == -1 or lengths[predecessor] >= radius:
+            continue
+        if length - radius <= radius - lengths[predecessor]:
+            nodes.add(node)
+        elif predecessors[predecessor] != -1:
+            nodes.add(predecessor)
+    return sorted(nodes)
@@ -0,0 +1,99 @@
+import os
+import time
+import uuid
+import threading
+from dataclasses import dataclass, field
+
+
+class JobStatus:
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+@dataclass
+class Job:
+    id: str
+    user_id: str | None
+    status: str = JobStatus.PENDING
+    result: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.monotonic)
+    finished_at: float | None = None
+
+
+class JobStore:
+    """
+    Thread-safe in-memory store of route jobs. Finished jobs are kept for `ttl` seconds,
+    when `max_jobs` is reached the oldest finished ones are dropped first. Jobs still pending
+    after `timeout` seconds are failed, later results of them are ignored.
+    """
+
+    def __init__(self, max_jobs: int, ttl: float, timeout: float):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.timeout = timeout
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def create(self, user_id: str | None) -> Job | None:
+        """
+        Register a new pending job, None if the store is full of unfinished jobs.
+        """
+        with self._lock:
+            self._evict()
+            if len(self._jobs) >= self.max_jobs:
+                return None
+            job = Job(id=uuid.uuid4().hex, user_id=user_id)
+            self._jobs[job.id] = job
+            return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def finish(self, job_id: str, result: dict) -> None:
+        self._update(job_id, status=JobStatus.DONE, result=result)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._update(job_id, status=JobStatus.FAILED, error=error)
+
+    def remove(self, job_id: str) -> None:
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _update(self, job_id: str, **changes) -> None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != JobStatus.PENDING:
+                return
+            for name, value in changes.items():
+                setattr(job, name, value)
+            job.finished_at = time.monotonic()
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for job in self._jobs.values():
+            if job.status == JobStatus.PENDING and now - job.created_at > self.timeout:
+                job.status = JobStatus.FAILED
+                job.error = 'Route generation timed out'
+                job.finished_at = now
+
+    def _evict(self) -> None:
+        self._expire()
+        now = time.monotonic()
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished_at is not None),
+            key=lambda job: job.finished_at
+        )
+        for job in finished:
+            if now - job.finished_at > self.ttl or len(self._jobs) >= self.max_jobs:
+                del self._jobs[job.id]
+
+
+route_jobs = JobStore(
+    max_jobs=int(os.environ.get('ROUTE_JOBS_MAX', 1000)),
+    ttl=float(os.environ.get('ROUTE_JOBS_TTL', 600)),
+    timeout=float(os.environ.get('ROUTE_JOB_TIMEOUT', 60))
+)
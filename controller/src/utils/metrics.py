@@ -0,0 +1,135 @@
+import time
+from contextlib import contextmanager
+
+from flask import Flask, Response
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, REGISTRY
+
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RETRY_COUNTERS = ('general_retries', 'return_path_retries', 'reverse_path_fallbacks')
+
+route_stage_seconds = Histogram(
+    'route_stage_seconds',
+    'Time spent in one stage of route generation',
+    ['stage'],
+    buckets=STAGE_BUCKETS
+)
+
+route_request_seconds = Histogram(
+    'route_request_seconds',
+    'Time spent handling a route generation request',
+    buckets=STAGE_BUCKETS
+)
+
+route_retries = Counter(
+    'route_retries',
+    'Retries and fallbacks of algorithm()',
+    ['kind']
+)
+
+graph_tile_loads = Counter(
+    'graph_tile_loads',
+    'Graph tiles loaded by the graph registries of the web and route worker processes'
+)
+
+graph_tile_evictions = Counter(
+    'graph_tile_evictions',
+    'Graph tiles evicted by the graph registries of the web and route worker processes'
+)
+
+route_engine_rejections = Counter(
+    'route_engine_rejections',
+    'Route jobs rejected because the route engine was saturated'
+)
+
+
+db_pool_wait_seconds = Histogram(
+    'db_pool_wait_seconds',
+    'Time spent waiting for a database connection from the pool',
+    buckets=STAGE_BUCKETS
+)
+
+db_pool_checkout_timeouts = Counter(
+    'db_pool_checkout_timeouts',
+    'Database connection checkouts which timed out waiting for a free connection'
+)
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """
+    Observe the duration of the block in the route_stage_seconds histogram.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        route_stage_seconds.labels(stage).observe(time.perf_counter() - start)
+
+
+@contextmanager
+def record_stage(stats: dict, stage: str):
+    """
+    Add the duration of the block to stats['stage_seconds'], for code which may run in a route
+    worker process. The parent observes them with observe_algorithm_stats.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds = stats.setdefault('stage_seconds', {})
+        stage_seconds[stage] = stage_seconds.get(stage, 0.0) + time.perf_counter() - start
+
+
+def observe_algorithm_stats(stats: dict) -> None:
+    """
+    Observe stage timings, retry counters and graph tile loads written to a stats dict.
+    """
+    for stage, seconds in stats.get('stage_seconds', {}).items():
+        route_stage_seconds.labels(stage).observe(seconds)
+    for kind in RETRY_COUNTERS:
+        if stats.get(kind):
+            route_retries.labels(kind).inc(stats[kind])
+    graph_tile_loads.inc(stats.get('tile_loads', 0))
+    graph_tile_evictions.inc(stats.get('tile_evictions', 0))
+
+
+class RouteCacheCollector:
+    def collect(self):
+        from .route_cache import route_cache
+
+        stats = route_cache.stats()
+        for name in ('hits', 'misses', 'evictions'):
+            yield CounterMetricFamily(f'route_cache_{name}', f'Route cache {name}', value=stats[name])
+        yield GaugeMetricFamily('route_cache_size', 'Routes held in the route cache', value=stats['size'])
+
+
+class GraphRegistryCollector:
+    def collect(self):
+        from .tiles import graph_registry
+
+        stats = graph_registry.stats()
+        yield GaugeMetricFamily('graph_registry_loaded_bytes', 'Bytes of graph arrays loaded by the web process', value=stats['loaded_bytes'])
+        yield GaugeMetricFamily('graph_registry_loaded_graphs', 'Tiles and merged graphs loaded by the web process', value=stats['loaded_graphs'])
+        yield GaugeMetricFamily('graph_registry_region_bytes', 'Bytes of whole region graphs held by the web process', value=stats['region_bytes'])
+
+
+class DatabasePoolCollector:
+    def collect(self):
+        from ..database import pool
+
+        stats = pool.stats()
+        yield GaugeMetricFamily('db_pool_size', 'Open database connections', value=stats['size'])
+        yield GaugeMetricFamily('db_pool_in_use', 'Database connections checked out', value=stats['in_use'])
+        yield GaugeMetricFamily('db_pool_utilization', 'Checked out share of the maximum pool size', value=stats['in_use'] / stats['max_size'])
+
+
+def configure_metrics(app: Flask) -> None:
+    REGISTRY.register(RouteCacheCollector())
+    REGISTRY.register(GraphRegistryCollector())
+    REGISTRY.register(DatabasePoolCollector())
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
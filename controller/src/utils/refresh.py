@@ -0,0 +1,161 @@
+"""
+Incremental refresh of the stored walk graph.
+
+    python -m src.utils.refresh [--graphml ...] [--green-areas ...] [--snapshot ...]
+
+Downloads the current network and green areas, keeps the green weights of edges which did not
+change and recomputes them only for new or modified edges and for edges near green areas which
+were added, removed or reshaped. The GraphML, green areas and snapshot are then rewritten.
+"""
+import os
+import time
+import logging
+import argparse
+
+import numpy as np
+import osmnx as ox
+import shapely
+import geopandas as gpd
+
+from .algorithm import (
+    GRAPH_FILEPATH, SNAPSHOT_FILEPATH, GREEN_AREAS_FILEPATH,
+    download_graph, fetch_green_areas, add_green_weights_to_graph, edge_midpoints, distance_to_green,
+    save_green_areas, save_graph_snapshot
+)
+
+
+log = logging.getLogger('GRAPH_REFRESH')
+
+COORDINATE_TOLERANCE = 1e-7
+LENGTH_TOLERANCE_M = 0.01
+
+
+class RefreshError(Exception):
+    pass
+
+
+def changed_edges(old_graph, new_graph) -> list[tuple]:
+    """
+    (u, v, key) of new_graph edges which are not in old_graph, belong to another OSM way, changed
+    length or have an end node which moved. Nodes and edges are matched by their OSM ids.
+    """
+    moved_nodes = {
+        node for node, data in new_graph.nodes(data=True)
+        if node not in old_graph.nodes
+        or abs(data['x'] - old_graph.nodes[node]['x']) > COORDINATE_TOLERANCE
+        or abs(data['y'] - old_graph.nodes[node]['y']) > COORDINATE_TOLERANCE
+    }
+
+    changed = []
+    for u, v, key, data in new_graph.edges(keys=True, data=True):
+        old_data = old_graph.get_edge_data(u, v, key)
+        if (
+            old_data is None
+            or u in moved_nodes or v in moved_nodes
+            or 'green_weight' not in old_data or 'avoid_green_weight' not in old_data
+            or old_data.get('osmid') != data.get('osmid')
+            or abs(float(old_data['length']) - float(data['length'])) > LENGTH_TOLERANCE_M
+        ):
+            changed.append((u, v, key))
+    return changed
+
+
+def changed_green_geometries(old_green_areas: gpd.GeoDataFrame, new_green_areas: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    Geometries of green areas which were added, removed or reshaped, both their old and new shapes.
+    old_green_areas is read from the file written by save_green_areas, areas are matched by the OSM ids in it.
+    """
+    def by_id(green_areas: gpd.GeoDataFrame) -> dict:
+        id_columns = [column for column in green_areas.columns if column != 'geometry']
+        return dict(zip(green_areas[id_columns].itertuples(index=False, name=None), green_areas.geometry.values))
+
+    old, new = by_id(old_green_areas), by_id(new_green_areas[['geometry']].reset_index())
+    changed = [old[key] for key in old.keys() - new.keys()] + [new[key] for key in new.keys() - old.keys()]
+    for key in old.keys() & new.keys():
+        if not shapely.equals_exact(old[key], new[key], tolerance=COORDINATE_TOLERANCE):
+            changed.extend((old[key], new[key]))
+    return np.asarray(changed, dtype=object)
+
+
+def refresh_graph(
+    graph_filepath=GRAPH_FILEPATH,
+    green_areas_filepath=GREEN_AREAS_FILEPATH,
+    snapshot_filepath=SNAPSHOT_FILEPATH,
+    new_graph=None,
+    new_green_areas=None
+) -> dict[str, int]:
+    """
+    Refresh the stored graph with new_graph and new_green_areas, downloaded when not given.
+    Returns counts of the edges and green areas which changed and of the reweighted edges.
+    Raises RefreshError, leaving the stored files untouched, when green areas cannot be fetched.
+    """
+    start = time.perf_counter()
+    old_graph = ox.load_graphml(graph_filepath)
+    old_green_areas = gpd.read_file(green_areas_filepath) if os.path.exists(green_areas_filepath) else None
+
+    if new_graph is None:
+        new_graph = download_graph()
+    if new_green_areas is None:
+        try:
+            new_green_areas = fetch_green_areas(new_graph)
+        except Exception as e:
+            raise RefreshError(f'Could not fetch green areas, stored graph left unchanged: {e}') from e
+
+    modified_edges = changed_edges(old_graph, new_graph)
+    modified = set(modified_edges)
+    unchanged_edges = [edge for edge in new_graph.edges(keys=True) if edge not in modified]
+
+    for u, v, key in unchanged_edges:
+        old_data = old_graph[u][v][key]
+        new_graph[u][v][key]['green_weight'] = float(old_data['green_weight'])
+        new_graph[u][v][key]['avoid_green_weight'] = float(old_data['avoid_green_weight'])
+
+    if old_green_areas is None:
+        log.info('No stored green areas, reweighting every edge')
+        green_geometries = np.asarray(new_green_areas.geometry.values, dtype=object)
+        reweighted_edges = list(new_graph.edges(keys=True))
+    else:
+        green_geometries = changed_green_geometries(old_green_areas, new_green_areas)
+        near_green = np.isfinite(distance_to_green(*edge_midpoints(new_graph, unchanged_edges), green_geometries)) \
+            if unchanged_edges else np.zeros(0, dtype=bool)
+        reweighted_edges = modified_edges + [edge for edge, near in zip(unchanged_edges, near_green.tolist()) if near]
+
+    result = {
+        'changed_edges': len(modified_edges),
+        'removed_edges': sum(1 for edge in old_graph.edges(keys=True) if not new_graph.has_edge(*edge)),
+        'changed_green_areas': len(green_geometries),
+        'reweighted_edges': len(reweighted_edges),
+    }
+
+    if not reweighted_edges and not result['removed_edges'] and old_green_areas is not None:
+        log.info(f'Graph is up to date, checked in {time.perf_counter() - start:.1f}s')
+        return result
+
+    if reweighted_edges:
+        add_green_weights_to_graph(new_graph, new_green_areas, edges=reweighted_edges)
+
+    save_green_areas(new_green_areas, green_areas_filepath)
+    ox.save_graphml(new_graph, filepath=graph_filepath)
+    save_graph_snapshot(new_graph, snapshot_filepath)
+
+    log.info(f'Graph refreshed in {time.perf_counter() - start:.1f}s: {result}')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--graphml', default=GRAPH_FILEPATH)
+    parser.add_argument('--green-areas', default=GREEN_AREAS_FILEPATH)
+    parser.add_argument('--snapshot', default=SNAPSHOT_FILEPATH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        refresh_graph(args.graphml, args.green_areas, args.snapshot)
+    except RefreshError as e:
+        log.error(e)
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
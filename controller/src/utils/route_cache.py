@@ -0,0 +1,70 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+class RouteCache:
+    """
+    Bounded LRU cache of generated routes with a time to live. Keys are built from quantized
+    request inputs by `key`, values are whatever algorithm() returned for them.
+    """
+
+    def __init__(self, max_size: int, ttl: float, distance_bucket: int, seeds: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.distance_bucket = distance_bucket
+        self.seeds = seeds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[tuple, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def quantize_distance(self, declared_distance: int) -> int:
+        return max(self.distance_bucket, round(declared_distance / self.distance_bucket) * self.distance_bucket)
+
+    @staticmethod
+    def key(start_node: int, distance: int, is_prefer_green: bool, is_avoid_green: bool, seed: int, alternatives: int) -> tuple:
+        return start_node, distance, bool(is_prefer_green), bool(is_avoid_green), seed, alternatives
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+route_cache = RouteCache(
+    max_size=int(os.environ.get('ROUTE_CACHE_SIZE', 2048)),
+    ttl=float(os.environ.get('ROUTE_CACHE_TTL', 3600)),
+    distance_bucket=int(os.environ.get('ROUTE_CACHE_DISTANCE_BUCKET', 100)),
+    seeds=int(os.environ.get('ROUTE_CACHE_SEEDS', 8))
+)
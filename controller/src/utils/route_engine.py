@@ -0,0 +1,129 @@
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+from .algorithm import algorithm, load_graph
+from .metrics import route_stage_seconds, route_engine_rejections, observe_algorithm_stats
+
+
+log = logging.getLogger('ROUTE_ENGINE')
+
+
+class RouteEngineSaturated(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__('Route engine is saturated')
+        self.retry_after = retry_after
+
+
+def run_algorithm(*args, **kwargs) -> tuple[object, dict]:
+    """
+    Call algorithm() and return its result with its stats, which carry the stage timings back
+    from the worker process.
+    """
+    stats = {}
+    start = time.perf_counter()
+    result = algorithm(*args, stats=stats, **kwargs)
+    stats['stage_seconds']['algorithm'] = time.perf_counter() - start
+    return result, stats
+
+
+class RouteEngine:
+    """
+    Runs `algorithm()` in a pool of worker processes, so route generation does not hold the GIL
+    of the web process. Every worker loads the graph snapshot, which is memory-mapped and so shared
+    read-only between them. At most `workers + queue_size` jobs are accepted at once, further
+    submissions raise RouteEngineSaturated. Every job gets a deadline `timeout` seconds after its
+    submission, past which algorithm() gives up with TimeoutError and frees its worker and slot.
+    With workers=0 jobs run in a single thread of the web process instead.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout: float, retry_after: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + queue_size)
+        self._executor: ProcessPoolExecutor | ThreadPoolExecutor | None = None
+        self._executor_lock = threading.Lock()
+        self._started = threading.Event()
+
+    def _create_executor(self) -> ProcessPoolExecutor | ThreadPoolExecutor:
+        if not self.workers:
+            return ThreadPoolExecutor(max_workers=1, thread_name_prefix='route-engine')
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=load_graph
+        )
+
+    def start(self) -> None:
+        """
+        Start the worker processes, call once the graph snapshot has been written by load_graph.
+        """
+        with self._executor_lock:
+            self._executor = self._create_executor()
+        log.info(f'Route engine started with {self.workers} workers')
+        self._started.set()
+
+    def submit(self, *args, **kwargs) -> Future:
+        """
+        Submit an algorithm() call, raises RouteEngineSaturated when all slots are taken.
+        """
+        if not self._slots.acquire(blocking=False):
+            route_engine_rejections.inc()
+            raise RouteEngineSaturated(self.retry_after)
+
+        submitted_at = time.perf_counter()
+        kwargs['deadline'] = time.time() + self.timeout
+
+        try:
+            if not self._started.wait(self.timeout):
+                raise TimeoutError('Route engine not started')
+
+            with self._executor_lock:
+                try:
+                    future = self._executor.submit(run_algorithm, *args, **kwargs)
+                except BrokenProcessPool:
+                    log.warning('Route worker died, restarting the pool')
+                    self._executor.shutdown(wait=False, cancel_futures=True)
+                    self._executor = self._create_executor()
+                    future = self._executor.submit(run_algorithm, *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        result = Future()
+        future.add_done_callback(lambda future: self._on_done(future, result, submitted_at))
+        return result
+
+    def run(self, *args, **kwargs):
+        """
+        Submit an algorithm() call and wait for its result, raises TimeoutError after the job timeout.
+        """
+        return self.submit(*args, **kwargs).result(timeout=self.timeout)
+
+    def _on_done(self, future: Future, result: Future, submitted_at: float) -> None:
+        self._slots.release()
+        elapsed = time.perf_counter() - submitted_at
+
+        try:
+            loops, stats = future.result()
+        except BaseException as e:
+            result.set_exception(e)
+            return
+
+        observe_algorithm_stats(stats)
+        route_stage_seconds.labels('engine_wait').observe(max(elapsed - stats['stage_seconds']['algorithm'], 0.0))
+        result.set_result(loops)
+
+
+route_engine = RouteEngine(
+    workers=int(os.environ.get('ROUTE_WORKERS', os.cpu_count() or 1)),
+    queue_size=int(os.environ.get('ROUTE_QUEUE_SIZE', 16)),
+    timeout=float(os.environ.get('ROUTE_JOB_TIMEOUT', 60)),
+    retry_after=int(os.environ.get('ROUTE_RETRY_AFTER', 5))
+)
@@ -0,0 +1,52 @@
+import numpy as np
+
+from .graph import EARTH_RADIUS_M
+
+
+def _segment_distances(points: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    segment = end - start
+    length_sq = float(segment @ segment)
+    if length_sq == 0.0:
+        return np.linalg.norm(points - start, axis=1)
+    t = np.clip((points - start) @ segment / length_sq, 0.0, 1.0)
+    return np.linalg.norm(points - (start + t[:, None] * segment), axis=1)
+
+
+def douglas_peucker_mask(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Mask of points kept by Douglas-Peucker simplification of a polyline with the given tolerance.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _segment_distances(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return keep
+
+
+def simplify_route(coords: list[tuple[float, float]], tolerance_m: float) -> list[tuple[float, float]]:
+    """
+    Drop route (longitude, latitude) points that deviate less than tolerance_m meters from the
+    simplified line, computed on equirectangular-projected coordinates. First and last points are kept.
+    """
+    if tolerance_m <= 0 or len(coords) < 3:
+        return coords
+
+    lonlat = np.asarray(coords, dtype=np.float64)
+    scale = np.cos(np.radians(lonlat[:, 1].mean()))
+    projected = np.radians(lonlat) * EARTH_RADIUS_M
+    projected[:, 0] *= scale
+
+    keep = douglas_peucker_mask(projected, tolerance_m)
+    return [point for point, kept in zip(coords, keep.tolist()) if kept]
@@ -0,0 +1,269 @@
+"""
+Registry of the routing graphs of all served regions.
+
+A region is either one graph held in memory or a directory of tiles cut from a region snapshot
+by `python -m src.utils.tiles <snapshot> <tiles directory>/<region>`. Tiles are loaded lazily,
+only those covering a request are merged into its graph, and least recently used tiles and merged
+graphs are dropped once the loaded arrays exceed the memory budget.
+"""
+import os
+import json
+import math
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .graph import RoutingGraph, EARTH_RADIUS_M
+
+
+log = logging.getLogger('GRAPH_REGISTRY')
+
+TILES_DIRECTORY = os.environ.get('GRAPH_TILES_DIR', '/app/graph/tiles')
+TILE_INDEX_FILENAME = 'index.json'
+DEFAULT_TILE_SIZE = 0.05
+REGION_MARGIN_DEG = 0.01
+
+
+class OutsideRegionsError(Exception):
+    def __init__(self, point: tuple[float]):
+        super().__init__(f'Point {point} is outside of all graph regions')
+        self.point = point
+
+
+@dataclass
+class Region:
+    name: str
+    bounds: tuple[float, float, float, float]
+    tile_size: float | None = None
+    tiles: dict[tuple[int, int], str] = field(default_factory=dict)
+    graph: RoutingGraph | None = None
+
+    def contains(self, point: tuple[float]) -> bool:
+        south, west, north, east = self.bounds
+        return south - REGION_MARGIN_DEG <= point[0] <= north + REGION_MARGIN_DEG and \
+            west - REGION_MARGIN_DEG <= point[1] <= east + REGION_MARGIN_DEG
+
+    def tiles_within(self, point: tuple[float], radius_m: float) -> list[tuple[int, int]]:
+        lat_radius = math.degrees(radius_m / EARTH_RADIUS_M)
+        lon_radius = lat_radius / max(math.cos(math.radians(point[0])), 1e-6)
+        rows = range(math.floor((point[0] - lat_radius) / self.tile_size), math.floor((point[0] + lat_radius) / self.tile_size) + 1)
+        cols = range(math.floor((point[1] - lon_radius) / self.tile_size), math.floor((point[1] + lon_radius) / self.tile_size) + 1)
+        return [(row, col) for row in rows for col in cols if (row, col) in self.tiles]
+
+
+class GraphRegistry:
+    """
+    Thread-safe registry of region graphs. `graph_for` returns the graph covering a point and
+    a radius around it, loading and merging tiles as needed and evicting cold ones to stay
+    within `memory_budget` bytes. Counts of loaded and evicted tiles are added to the stats dict.
+
+    The lock only guards the LRU bookkeeping. Tiles are loaded, merged and indexed outside of it,
+    requests needing a graph which is being built wait for it on its future.
+    """
+
+    def __init__(self, memory_budget: int):
+        self.memory_budget = memory_budget
+        self.loads = 0
+        self.evictions = 0
+        self._regions: dict[str, Region] = {}
+        self._loaded: OrderedDict[tuple, RoutingGraph] = OrderedDict()
+        self._pending: dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def regions(self) -> list[str]:
+        return list(self._regions)
+
+    def bounds(self) -> list[tuple[float, float, float, float]]:
+        with self._lock:
+            return [region.bounds for region in self._regions.values()]
+
+    def register(self, name: str, graph: RoutingGraph) -> None:
+        """
+        Serve a region from one graph held in memory, it is never evicted.
+        """
+        bounds = (float(graph.y.min()), float(graph.x.min()), float(graph.y.max()), float(graph.x.max()))
+        with self._lock:
+            self._regions[name] = Region(name=name, bounds=bounds, graph=graph)
+
+    def add_tiles_directory(self, directory: str = TILES_DIRECTORY) -> None:
+        """
+        Register every tiled region found in directory, regions are its subdirectories with a tile index.
+        """
+        if not os.path.isdir(directory):
+            return
+        for name in sorted(os.listdir(directory)):
+            index_filepath = os.path.join(directory, name, TILE_INDEX_FILENAME)
+            if not os.path.exists(index_filepath):
+                continue
+            with open(index_filepath) as file:
+                index = json.load(file)
+            region = Region(
+                name=name,
+                bounds=tuple(index['bounds']),
+                tile_size=index['tile_size'],
+                tiles={
+                    tuple(map(int, key.split('_'))): os.path.join(directory, name, key) for key in index['tiles']
+                }
+            )
+            with self._lock:
+                self._regions[name] = region
+            log.info(f'Region {name} registered with {len(region.tiles)} tiles')
+
+    def region_of(self, point: tuple[float]) -> Region:
+        for region in self._regions.values():
+            if region.contains(point):
+                return region
+        raise OutsideRegionsError(point)
+
+    def graph_for(self, point: tuple[float], radius_m: float = 0.0, stats: dict | None = None) -> RoutingGraph:
+        """
+        Graph covering the (latitude, longitude) point and radius_m meters around it.
+        """
+        region = self.region_of(point)
+        if region.graph is not None:
+            return region.graph
+
+        tiles = region.tiles_within(point, radius_m)
+        if not tiles:
+            raise OutsideRegionsError(point)
+
+        graphs, loads = [], 0
+        for tile in tiles:
+            graph, loaded = self._get(('tile', region.name, tile), lambda tile=tile: self._load_tile(region, tile))
+            graphs.append(graph)
+            loads += loaded
+        if len(graphs) == 1:
+            graph = graphs[0]
+        else:
+            graph, _ = self._get(('merged', region.name, frozenset(tiles)), lambda: RoutingGraph.merge(graphs))
+
+        with self._lock:
+            evictions = self._evict(keep={('tile', region.name, tile) for tile in tiles} | {('merged', region.name, frozenset(tiles))})
+
+        if stats is not None:
+            stats['tile_loads'] = stats.get('tile_loads', 0) + loads
+            stats['tile_evictions'] = stats.get('tile_evictions', 0) + evictions
+        return graph
+
+    def _get(self, key: tuple, load) -> tuple[RoutingGraph, bool]:
+        """
+        Loaded graph of key and whether this call loaded it. Only the first caller of a missing key
+        runs load, concurrent callers wait for its result.
+        """
+        with self._lock:
+            graph = self._loaded.get(key)
+            if graph is not None:
+                self._loaded.move_to_end(key)
+                return graph, False
+            pending = self._pending.get(key)
+            is_loader = pending is None
+            if is_loader:
+                pending = self._pending[key] = Future()
+
+        if not is_loader:
+            return pending.result(), False
+
+        try:
+            graph = load()
+            graph.build_spatial_index()
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            pending.set_exception(e)
+            raise
+
+        with self._lock:
+            self._loaded[key] = graph
+            del self._pending[key]
+            if key[0] == 'tile':
+                self.loads += 1
+        pending.set_result(graph)
+        return graph, True
+
+    def _load_tile(self, region: Region, tile: tuple[int, int]) -> RoutingGraph:
+        start = time.perf_counter()
+        graph = RoutingGraph.load(region.tiles[tile])
+        log.info(f'Tile {tile} of {region.name} loaded in {time.perf_counter() - start:.2f}s')
+        return graph
+
+    def _evict(self, keep: set[tuple]) -> int:
+        """
+        Drop least recently used graphs not in keep until within the memory budget, returns the
+        number of evicted tiles. Call with the lock held.
+        """
+        loaded_bytes = sum(graph.nbytes for graph in self._loaded.values())
+        evictions = 0
+        for key in list(self._loaded):
+            if loaded_bytes <= self.memory_budget:
+                break
+            if key in keep:
+                continue
+            loaded_bytes -= self._loaded.pop(key).nbytes
+            if key[0] == 'tile':
+                evictions += 1
+        self.evictions += evictions
+        return evictions
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'regions': len(self._regions),
+                'loaded_graphs': len(self._loaded),
+                'loaded_bytes': sum(graph.nbytes for graph in self._loaded.values()),
+                'region_bytes': sum(region.graph.nbytes for region in self._regions.values() if region.graph is not None),
+                'loads': self.loads,
+                'evictions': self.evictions,
+            }
+
+
+graph_registry = GraphRegistry(
+    memory_budget=int(os.environ.get('GRAPH_MEMORY_BUDGET_MB', 1024)) * 2 ** 20
+)
+
+
+def split_into_tiles(graph: RoutingGraph, directory: str, tile_size: float = DEFAULT_TILE_SIZE) -> None:
+    """
+    Cut graph into tile_size x tile_size degree tiles and save them with their index to directory.
+    Every node belongs to the tile it lies in, edges to the tile of their source node.
+    """
+    rows = np.floor(np.asarray(graph.y) / tile_size).astype(np.int64)
+    cols = np.floor(np.asarray(graph.x) / tile_size).astype(np.int64)
+    cells = np.unique(np.column_stack((rows, cols)), axis=0)
+
+    os.makedirs(directory, exist_ok=True)
+    tiles = {}
+    for row, col in cells.tolist():
+        key = f'{row}_{col}'
+        tile = graph.subgraph(np.flatnonzero((rows == row) & (cols == col)))
+        tile.save(os.path.join(directory, key))
+        tiles[key] = {'nodes': len(tile), 'edges': tile.num_edges, 'bytes': tile.nbytes}
+
+    with open(os.path.join(directory, TILE_INDEX_FILENAME), 'w') as file:
+        json.dump({
+            'tile_size': tile_size,
+            'bounds': [float(graph.y.min()), float(graph.x.min()), float(graph.y.max()), float(graph.x.max())],
+            'tiles': tiles,
+        }, file)
+    log.info(f'{len(tiles)} tiles written to {directory}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cut a graph snapshot into tiles of a region')
+    parser.add_argument('snapshot', help='Graph snapshot directory')
+    parser.add_argument('directory', help='Region directory inside the tiles directory')
+    parser.add_argument('--tile-size', type=float, default=DEFAULT_TILE_SIZE, help='Tile size in degrees')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    split_into_tiles(RoutingGraph.load(args.snapshot, mmap=False), args.directory, args.tile_size)
+
+
+if __name__ == '__main__':
+    main()
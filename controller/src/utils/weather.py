@@ -1,42 +1,204 @@
 import os
-import requests
+import math
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
+import requests
+from requests.adapters import HTTPAdapter
+
+
+log = logging.getLogger('WEATHER')
 
 API_KEY = os.environ.get("WEATHER_KEY")
 BASE_URL = os.environ.get("WEATHER_URL")
 
-def get_weather_info(lat, lon):
-    location = f"{lat},{lon}"
-
-    now = datetime.now()
-    past_6h = now - timedelta(hours=6)
-    history_url = f"{BASE_URL}/history.json?key={API_KEY}&q={location}&dt={past_6h.strftime('%Y-%m-%d')}"
-    history_response = requests.get(history_url)
-
-    rain_past_6h = False
-    if history_response.status_code == 200:
-        history_data = history_response.json()
-        for hour in history_data.get("forecast", {}).get("forecastday", [])[0].get("hour", []):
-            hour_time = datetime.strptime(hour["time"], "%Y-%m-%d %H:%M")
-            if past_6h <= hour_time <= now and hour.get("precip_mm", 0) >= 0.5:
-                rain_past_6h = True
+RAIN_THRESHOLD_MM = 0.5
+
+
+class WeatherClient:
+    """
+    Client of the weather API. History and forecast are requested in parallel over one pooled
+    session with strict timeouts. Weather is tracked per geo cell of `cell_size` degrees and
+    requested for the centre of the cell.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        connect_timeout: float,
+        read_timeout: float,
+        cell_size: float,
+        pool_size: int
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.timeout = (connect_timeout, read_timeout)
+        self.cell_size = cell_size
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='weather')
+
+    def cell(self, lat: float, lon: float) -> tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def cell_center(self, cell: tuple[int, int]) -> tuple[float, float]:
+        return (cell[0] + 0.5) * self.cell_size, (cell[1] + 0.5) * self.cell_size
+
+    def fetch(self, lat: float, lon: float, now: datetime) -> tuple[dict[str, bool], bool]:
+        """
+        Rain in the past 6 hours and in the next 2 hours at the point, and whether both calls succeeded.
+        Raises requests exceptions on connection errors and timeouts.
+        """
+        location = f"{lat},{lon}"
+        past_6h = now - timedelta(hours=6)
+
+        history = self._executor.submit(
+            self.session.get, f"{self.base_url}/history.json",
+            params={'key': self.api_key, 'q': location, 'dt': past_6h.strftime('%Y-%m-%d')}, timeout=self.timeout
+        )
+        forecast = self._executor.submit(
+            self.session.get, f"{self.base_url}/forecast.json",
+            params={'key': self.api_key, 'q': location, 'hours': 2}, timeout=self.timeout
+        )
+        history_response, forecast_response = history.result(), forecast.result()
+
+        return {
+            "rain_past_6h": history_response.status_code == 200 and
+                            is_rainy(history_response.json(), past_6h, now),
+            "rain_next_2h": forecast_response.status_code == 200 and
+                            is_rainy(forecast_response.json(), now, now + timedelta(hours=2)),
+        }, history_response.status_code == 200 and forecast_response.status_code == 200
+
+
+class WeatherPrefetcher:
+    """
+    Background refresher of the rain flags of every weather cell covering the served regions.
+    Cells are refreshed every `interval` seconds, never fetched and oldest first, spending at most
+    `calls_per_hour` API calls in any hour. Route generation reads the table with `lookup` only,
+    entries older than `stale_after` seconds are still returned but flagged as stale.
+
+    The call budget is counted per process, every started prefetcher spends its own
+    WEATHER_CALLS_PER_HOUR. app.py starts it in the serving process only, so with more
+    controller processes the budget has to be divided between them.
+    """
+
+    CALLS_PER_CELL = 2
+
+    def __init__(self, client: WeatherClient, interval: float, calls_per_hour: int, stale_after: float):
+        self.client = client
+        self.interval = interval
+        self.calls_per_hour = calls_per_hour
+        self.stale_after = stale_after
+        self._cells: list[tuple[int, int]] = []
+        self._table: dict[tuple[int, int], tuple[float, dict[str, bool]]] = {}
+        self._calls: deque[float] = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self, bounds: list[tuple[float, float, float, float]]) -> None:
+        """
+        Start refreshing the cells covering the (south, west, north, east) bounds.
+        """
+        cells = set()
+        for south, west, north, east in bounds:
+            (first_row, first_col), (last_row, last_col) = self.client.cell(south, west), self.client.cell(north, east)
+            cells.update((row, col) for row in range(first_row, last_row + 1) for col in range(first_col, last_col + 1))
+        with self._lock:
+            self._cells = sorted(cells)
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='weather-prefetch', daemon=True)
+            self._thread.start()
+        log.info(f'Weather prefetch started for {len(cells)} cells')
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def lookup(self, lat: float, lon: float) -> dict | None:
+        """
+        Rain flags of the cell of the point with is_stale, None if the cell was never fetched.
+        """
+        with self._lock:
+            entry = self._table.get(self.client.cell(lat, lon))
+        if entry is None:
+            return None
+        fetched_at, weather_info = entry
+        return {**weather_info, 'is_stale': time.monotonic() - fetched_at > self.stale_after}
+
+    def _remaining_calls(self, now: float) -> int:
+        while self._calls and self._calls[0] <= now - 3600:
+            self._calls.popleft()
+        return self.calls_per_hour - len(self._calls)
+
+    def refresh(self) -> int:
+        """
+        Refresh the cells due within the call budget, returns the number of refreshed cells.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = sorted(
+                (self._table[cell][0] if cell in self._table else -math.inf, cell)
+                for cell in self._cells
+                if cell not in self._table or now - self._table[cell][0] >= self.interval
+            )
+
+        refreshed = 0
+        for _, cell in due:
+            if self._stop.is_set() or self._remaining_calls(time.monotonic()) < self.CALLS_PER_CELL:
                 break
+            self._calls.extend([time.monotonic()] * self.CALLS_PER_CELL)
+            try:
+                weather_info, complete = self.client.fetch(*self.client.cell_center(cell), datetime.now())
+            except requests.RequestException as e:
+                log.warning(f'Weather prefetch of cell {cell} failed: {e}')
+                continue
+            if complete:
+                with self._lock:
+                    self._table[cell] = (time.monotonic(), weather_info)
+                refreshed += 1
+
+        if len(due) > refreshed:
+            log.info(f'Weather prefetch refreshed {refreshed} of {len(due)} due cells')
+        return refreshed
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as e:
+                log.exception(f'Weather prefetch error: {e}')
+            self._stop.wait(min(self.interval, 60))
+
+
+def is_rainy(data: dict, since: datetime, until: datetime) -> bool:
+    forecast_day = next(iter(data.get("forecast", {}).get("forecastday", [])), {})
+    for hour in forecast_day.get("hour", []):
+        hour_time = datetime.strptime(hour["time"], "%Y-%m-%d %H:%M")
+        if since <= hour_time <= until and hour.get("precip_mm", 0) >= RAIN_THRESHOLD_MM:
+            return True
+    return False
+
+
+weather_client = WeatherClient(
+    base_url=BASE_URL,
+    api_key=API_KEY,
+    connect_timeout=float(os.environ.get('WEATHER_CONNECT_TIMEOUT', 0.5)),
+    read_timeout=float(os.environ.get('WEATHER_READ_TIMEOUT', 1.5)),
+    cell_size=float(os.environ.get('WEATHER_CELL_SIZE', 0.05)),
+    pool_size=int(os.environ.get('WEATHER_POOL_SIZE', 8))
+)
+
 
-    forecast_url = f"{BASE_URL}/forecast.json?key={API_KEY}&q={location}&hours=2"
-    forecast_response = requests.get(forecast_url)
-
-    rain_next_2h = False
-    if forecast_response.status_code == 200:
-        forecast_data = forecast_response.json()
-        for hour in forecast_data.get("forecast", {}).get("forecastday", [])[0].get("hour", []):
-            hour_time = datetime.strptime(hour["time"], "%Y-%m-%d %H:%M")
-            if now <= hour_time <= now + timedelta(hours=2):
-                if hour.get("precip_mm", 0) >= 0.5:
-                    rain_next_2h = True
-                    break
-
-    return {
-        "rain_past_6h": rain_past_6h,
-        "rain_next_2h": rain_next_2h
-    }
\ No newline at end of file
+weather_prefetcher = WeatherPrefetcher(
+    client=weather_client,
+    interval=float(os.environ.get('WEATHER_PREFETCH_INTERVAL', 1800)),
+    calls_per_hour=int(os.environ.get('WEATHER_CALLS_PER_HOUR', 600)),
+    stale_after=float(os.environ.get('WEATHER_STALE_AFTER', 3600))
+)
@@ -48,3 +48,33 @@ class Scan(Resource):
             socket.emit('notification_scan', json_data, room=user_id)
 
         return {}, 200
+
+
+route_ready_input_model = api.model(
+    'Route ready input model',
+    {
+        'user_owner_id': fields.String(required=True, description='Unique ID of the user'),
+        'notification_id': fields.String(required=True, description='Unique ID of the route job'),
+        'data': fields.Raw(required=True, description='Route job status and result'),
+        'timestamp': fields.String(required=True, description='Time of job completion')
+    }
+)
+
+
+@api.route('/route_ready')
+class RouteReady(Resource):
+    @api.expect(route_ready_input_model, validate=True)
+    @api.response(200, 'OK')
+    @api.response(400, 'Bad Request')
+    def post(self):
+        json_data = request.get_json()
+
+        user_id = json_data.pop('user_owner_id')
+        json_data['notification_type'] = 'route_ready'
+
+        socket = Websocket()
+
+        if socket.is_connected(user_id):
+            socket.emit('route_ready', json_data, room=user_id)
+
+        return {}, 200
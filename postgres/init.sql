@@ -10,7 +10,8 @@ CREATE TABLE IF NOT EXISTS users (
     profile_picture_url TEXT,
     is_premium BOOLEAN DEFAULT FALSE,
     is_private BOOLEAN DEFAULT FALSE,
-    date_joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    date_joined TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    route_count INT NOT NULL DEFAULT 0
 );
 
 CREATE TABLE IF NOT EXISTS routes (
@@ -24,4 +25,25 @@ CREATE TABLE IF NOT EXISTS routes (
     start_point geometry(POINT, 4326),
     route geometry(LINESTRING, 4326),
     "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+);
+
+CREATE INDEX IF NOT EXISTS routes_user_id_timestamp_idx ON routes (user_id, "timestamp");
+CREATE INDEX IF NOT EXISTS routes_start_point_idx ON routes USING GIST (start_point);
+CREATE INDEX IF NOT EXISTS routes_route_idx ON routes USING GIST (route);
+
+CREATE OR REPLACE FUNCTION update_user_route_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE users SET route_count = route_count + 1 WHERE id = NEW.user_id;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE users SET route_count = route_count - 1 WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS routes_user_route_count ON routes;
+CREATE TRIGGER routes_user_route_count
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON routes
+    FOR EACH ROW EXECUTE FUNCTION update_user_route_count();
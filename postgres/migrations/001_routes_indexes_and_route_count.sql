@@ -0,0 +1,33 @@
+-- Indexes of the routes table and per-user route counter kept up to date by a trigger.
+-- Safe to run more than once: psql -U petwalk -d petwalk_db -f 001_routes_indexes_and_route_count.sql
+
+BEGIN;
+
+LOCK TABLE routes IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE INDEX IF NOT EXISTS routes_user_id_timestamp_idx ON routes (user_id, "timestamp");
+CREATE INDEX IF NOT EXISTS routes_start_point_idx ON routes USING GIST (start_point);
+CREATE INDEX IF NOT EXISTS routes_route_idx ON routes USING GIST (route);
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS route_count INT NOT NULL DEFAULT 0;
+
+UPDATE users SET route_count = (SELECT COUNT(*) FROM routes WHERE routes.user_id = users.id);
+
+CREATE OR REPLACE FUNCTION update_user_route_count() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE users SET route_count = route_count + 1 WHERE id = NEW.user_id;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE users SET route_count = route_count - 1 WHERE id = OLD.user_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS routes_user_route_count ON routes;
+CREATE TRIGGER routes_user_route_count
+    AFTER INSERT OR DELETE OR UPDATE OF user_id ON routes
+    FOR EACH ROW EXECUTE FUNCTION update_user_route_count();
+
+COMMIT;